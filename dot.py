@@ -3,17 +3,22 @@
 Manage links to dotfiles.
 """
 
-__all__: list[str] = ["dot"]
+__all__: list[str] = ["Planner", "Result", "dot"]
 __ALL__: list[str] = dir() + __all__
 
+import hashlib
+import json
 import logging
 import os
-import re
 import sys
-from argparse import ArgumentParser, BooleanOptionalAction
+import threading
+import time
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
 from pathlib import Path
+from stat import S_ISREG
 from string import Template
-from typing import Callable
+from typing import Callable, ClassVar, NamedTuple, Optional
 
 
 def __dir__() -> list[str]:
@@ -50,142 +55,1746 @@ class ColoredFormatter(logging.Formatter):
         )
 
     def format(self, record: logging.LogRecord) -> str:
-        record.msg = self.format_(record.msg, record.levelno)
-        return logging.Formatter().format(record)
+        # NOTE record is left untouched, so that other handlers do not color it again
+        return self.format_(super().format(record), record.levelno)
+
+
+class JSONFormatter(logging.Formatter):
+    FIELDS: tuple[str, ...] = ("op", "dotfile", "target", "status")
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {"level": record.levelname.lower(), "message": record.getMessage()}
+        data.update((field, getattr(record, field)) for field in self.FIELDS if hasattr(record, field))
+        return json.dumps(data)
 
 
 def get_logger() -> logging.Logger:
-    logger = logging.getLogger()
+    """
+    Add handler to logger of dot.py on first use, instead of configuring the root logger when imported.
+    """
+    logger = logging.getLogger("dot.py")
+    if any(handler.get_name() == "dot.py" for handler in logger.handlers):
+        return logger
 
     handler = logging.StreamHandler()
     handler.setLevel(logging.DEBUG)
     handler.setFormatter(formatter)
+    handler.set_name("dot.py")
     logger.addHandler(handler)
 
     return logger
 
 
-def render_link_recurse(*, candidate, recursive, queue, **_) -> None:
+def log(level, msg, *args, op, status, dotfile, target=None) -> None:
+    """
+    Log outcome of an operation on a dotfile, with fields for structured logs, only when the level is enabled.
+    """
+    if logger.isEnabledFor(level):
+        fields = {"op": op, "status": status, "dotfile": str(dotfile), "target": target and str(target)}
+        logger.log(level, msg, *args, extra=fields)
+
+
+def state_path(name, kind="cache") -> Path:
+    """
+    Return path to a file kept between runs in the XDG cache or state directory.
+    """
+    if kind == "cache":
+        base = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    else:
+        base = os.environ.get("XDG_STATE_HOME") or Path.home() / ".local" / "state"
+    return Path(base) / "dot.py" / name
+
+
+def load_json(path, default):
+    try:
+        with open(path, "r", encoding="utf-8") as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return default
+
+
+def save_json(path, data) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(tmp, "w", encoding="utf-8") as fp:
+        json.dump(data, fp, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def file_digest(path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(1 << 16), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class RenderCache:
+    """
+    Rendered files with their template, the variables it references and a key derived from both.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {key: value for key, value in load_json(path, {}).items() if isinstance(value, dict)}
+        # NOTE any entry of a template tells its digest and variables while its size and mtime are unchanged
+        self.templates = {entry.get("template"): entry for entry in self.entries.values()}
+        self.changed = False
+        self.planned = set()
+        self.skipped = 0
+        self.written = 0
+
+    @staticmethod
+    def read(template) -> tuple[str, str]:
+        """
+        Return digest of template and variables it references, reading it line by line.
+        """
+        digest, identifiers = hashlib.sha256(), set()
+        with open(template, "r", encoding="utf-8") as template_file:
+            for line in template_file:
+                digest.update(line.encode("utf-8"))
+                identifiers.update(m.group("named") or m.group("braced") for m in Template.pattern.finditer(line))
+        return digest.hexdigest(), ",".join(sorted(identifiers - {None}))
+
+    @staticmethod
+    def key(digest, variables) -> str:
+        values = {variable: os.environ.get(variable) for variable in variables.split(",") if variable}
+        # NOTE only a digest is kept, so that values of secrets are never written to disk
+        return hashlib.sha256(json.dumps([digest, values]).encode("utf-8")).hexdigest()
+
+    def add(self, rendered, **entry) -> None:
+        self.entries[str(rendered)] = entry
+        self.templates[entry["template"]] = entry
+        self.changed = True
+
+    def dependencies(self) -> dict[str, list[str]]:
+        """
+        Return templates depending on each variable.
+        """
+        dependencies = {}
+        for entry in self.entries.values():
+            for variable in filter(None, entry["variables"].split(",")):
+                dependencies.setdefault(variable, []).append(entry["template"])
+        return {variable: sorted(templates) for variable, templates in sorted(dependencies.items())}
+
+    def save(self) -> None:
+        if self.changed:
+            save_json(self.path, self.entries)
+
+
+class TemplateCache:
+    """
+    Templates compiled to literal segments and placeholders, one file each, evicted least recently used first.
+    """
+
+    # NOTE larger templates are rendered line by line instead of being compiled
+    MAX_TEMPLATE: int = 1 << 20
+    MAX_CACHE: int = 16 << 20
+    MAX_COMPILED: int = 1024
+    # NOTE templates compiled are also kept in memory, for processes rendering more than once, shared by jobs threads
+    compiled: ClassVar[OrderedDict] = OrderedDict()
+    lock: ClassVar[threading.Lock] = threading.Lock()
+
+    def __init__(self, path):
+        self.path = path
+
+    @staticmethod
+    def compile(content) -> list:
+        """
+        Split content into literal strings and [variable, placeholder] pairs, merging adjacent literals.
+        """
+        segments: list[str | list[str]] = [""]
+        position = 0
+        for match in Template.pattern.finditer(content):
+            segments[-1] += content[position : match.start()]
+            variable = match.group("named") or match.group("braced")
+            if variable is None:
+                # NOTE both escaped and invalid delimiters render as the delimiter
+                segments[-1] += Template.delimiter
+            else:
+                segments.extend([[variable, match.group()], ""])
+            position = match.end()
+        segments[-1] += content[position:]
+        return segments
+
+    @staticmethod
+    def substitute(segments, mapping) -> str:
+        return "".join(s if isinstance(s, str) else mapping.get(s[0], s[1]) for s in segments)
+
+    def segments(self, template, stat) -> list:
+        """
+        Return compiled template, compiling it when its size or mtime changed.
+        """
+        with self.lock:
+            if (str(template), stat) in self.compiled:
+                self.compiled.move_to_end((str(template), stat))
+                return self.compiled[str(template), stat]
+        path = self.path / (hashlib.sha256(str(template).encode("utf-8")).hexdigest()[:32] + ".json")
+        entry = load_json(path, {})
+        if entry.get("template") == str(template) and entry.get("stat") == stat:
+            # NOTE mtime of cached file records when it was last used
+            os.utime(path)
+            segments = entry["segments"]
+        else:
+            with open(template, "r", encoding="utf-8") as template_file:
+                segments = self.compile(template_file.read())
+            save_json(path, {"template": str(template), "stat": stat, "segments": segments})
+        with self.lock:
+            self.compiled[str(template), stat] = segments
+            if len(self.compiled) > self.MAX_COMPILED:
+                self.compiled.popitem(last=False)
+        return segments
+
+    def evict(self) -> None:
+        if not self.path.is_dir():
+            return
+        entries = []
+        with os.scandir(self.path) as scan:
+            for entry in scan:
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    # NOTE removed meanwhile by another run
+                    continue
+                if entry.name.endswith(".json"):
+                    entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        entries.sort()
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, path in entries:
+            if size <= self.MAX_CACHE:
+                break
+            Path(path).unlink(missing_ok=True)
+            size -= entry_size
+
+
+class Manifest:
+    """
+    Links created in a home, with their target, profile and mode.
+    """
+
+    def __init__(self, home):
+        digest = hashlib.sha256(str(home).encode("utf-8")).hexdigest()[:16]
+        self.path = state_path(f"links-{digest}.json", kind="state")
+        self.home = str(home)
+        data = load_json(self.path, {})
+        self.links = data.get("links", {}) if data.get("home") == self.home else {}
+        # NOTE stores linked to before are told too when links to them are removed
+        self.linked_stores = self.stores()
+        self.changed = False
+
+    def add(self, dotfile, target, profile, mode) -> None:
+        entry = {"target": str(target), "profile": str(profile), "mode": mode}
+        if self.links.get(str(dotfile)) != entry:
+            self.links[str(dotfile)] = entry
+            self.changed = True
+
+    def remove(self, dotfile) -> None:
+        if self.links.pop(str(dotfile), None) is not None:
+            self.changed = True
+
+    def restore(self, dotfile, entry) -> None:
+        if entry is None:
+            self.remove(dotfile)
+        elif self.links.get(str(dotfile)) != entry:
+            self.links[str(dotfile)] = entry
+            self.changed = True
+
+    def profiles(self) -> list[str]:
+        # NOTE folders created to hold links of several profiles belong to none
+        return sorted({entry["profile"] for entry in self.links.values() if entry["mode"] != "directory"})
+
+    def entries(self, profile):
+        for dotfile, entry in sorted(self.links.items()):
+            if entry["profile"] == str(profile):
+                yield Path(dotfile), entry
+
+    def stores(self) -> set[str]:
+        return {str(Path(entry["target"]).parents[1]) for entry in self.links.values() if entry["mode"] == "stored"}
+
+    def save(self) -> None:
+        if self.changed:
+            save_json(self.path, {"home": self.home, "links": self.links})
+            for store in sorted(self.linked_stores | self.stores()):
+                Store(store).save_refs(self)
+
+
+class Store:
+    """
+    Rendered files named after the key of their template and values, written once for all profiles and homes.
+
+    Entries of templates without variables are shared by all users, others are private to the user rendering them.
+    Each home records the entries it links to, so that entries no home links to anymore can be removed.
+    """
+
+    # NOTE entries written by a run still in progress are not recorded yet
+    GRACE: int = 3600
+
+    def __init__(self, path):
+        self.path = Path(path).expanduser().resolve()
+
+    def entry(self, key, variables="") -> Path:
+        # NOTE entries holding values are only readable by their owner, so each user renders their own
+        return self.path / "objects" / (f"{key}-{os.getuid()}" if variables else key)
+
+    @staticmethod
+    def trusted(path) -> bool:
+        """
+        Return whether path is a file written by the current user or root, rather than by another user of the store.
+        """
+        try:
+            entry = os.lstat(path)
+        except OSError:
+            return False
+        return S_ISREG(entry.st_mode) and entry.st_uid in (0, os.getuid())
+
+    def save_refs(self, manifest) -> None:
+        """
+        Record entries linked to from the home of manifest.
+        """
+        links = manifest.links.values()
+        keys = sorted({Path(e["target"]).name for e in links if e["mode"] == "stored" and self.owns(e["target"])})
+        path = self.path / "refs" / manifest.path.name.removeprefix("links-")
+        if keys:
+            save_json(path, {"home": manifest.home, "keys": keys})
+        else:
+            path.unlink(missing_ok=True)
+
+    def owns(self, target) -> bool:
+        return Path(target).parent == self.path / "objects"
+
+    def unreferenced(self) -> list[tuple[Path, int]]:
+        """
+        Return entries no home links to, with their size.
+        """
+        referenced = set()
+        for path in (self.path / "refs").glob("*.json"):
+            referenced.update(load_json(path, {}).get("keys", []))
+        if not (self.path / "objects").is_dir():
+            return []
+        entries, now = [], time.time()
+        with os.scandir(self.path / "objects") as scan:
+            for entry in scan:
+                # NOTE hidden files are renders being written
+                if entry.name in referenced or entry.name.startswith("."):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                if stat.st_mtime < now - self.GRACE:
+                    entries.append((Path(entry.path), stat.st_size))
+        return sorted(entries)
+
+
+class Journal:
+    """
+    Operations planned for a home, followed by each one completed, appended as they complete.
+
+    A run killed or failing while applying leaves its journal behind, to resume or roll back from.
+    """
+
+    def __init__(self, manifest):
+        self.path = manifest.path.with_name(manifest.path.stem.replace("links-", "journal-", 1) + ".jsonl")
+        self.index = {}
+        self.fd = None
+
+    def start(self, queue, manifest, links=None, done=()) -> None:
+        """
+        Write operations in queue, along with links they change as recorded before, and ones already done.
+        """
+        self.index = {operation: index for index, operation in enumerate(queue)}
+        if links is None:
+            links = {str(operation[0]): manifest.links.get(str(operation[0])) for operation in queue}
+        lines = [{"home": manifest.home, "operations": [dump_operation(op) for op in queue], "links": links}]
+        lines.extend({"done": self.index[operation]} for operation in done)
+        tmp = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(tmp, "w", encoding="utf-8") as fp:
+            fp.writelines(json.dumps(line) + "\n" for line in lines)
+        os.replace(tmp, self.path)
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+
+    def done(self, operation) -> None:
+        if self.fd is None:
+            raise RuntimeError(f"Journal {self.path} was not started")
+        # NOTE a single write to a file opened for appending is not interleaved with writes of other threads
+        os.write(self.fd, f'{{"done": {self.index[operation]}}}\n'.encode())
+
+    def close(self, keep=False) -> None:
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        if not keep:
+            self.path.unlink(missing_ok=True)
+
+    def load(self) -> Optional[tuple[list, list, dict]]:
+        """
+        Return operations planned, operations done in the order they completed and links recorded before, if any.
+        """
+        try:
+            with open(self.path, "r", encoding="utf-8") as fp:
+                header, *lines = fp.readlines()
+            header = json.loads(header)
+            queue = [load_operation(item) for item in header["operations"]]
+        except (OSError, ValueError, KeyError):
+            return None
+        done = []
+        for line in lines:
+            try:
+                done.append(queue[json.loads(line)["done"]])
+            except (ValueError, KeyError, IndexError):
+                # NOTE last line is cut when the run was killed while writing it
+                break
+        return queue, list(dict.fromkeys(done)), header["links"]
+
+
+class Stats:
+    """
+    Wall time spent in each phase of a run and count of filesystem operations by kind.
+    """
+
+    def __init__(self):
+        self.phases = Counter()
+        self.calls = Counter()
+        self.stack = []
+        self.start = time.perf_counter()
+
+    @contextmanager
+    def phase(self, name):
+        # NOTE time of nested phases is only counted for the innermost one
+        now = time.perf_counter()
+        if self.stack:
+            self.phases[self.stack[-1]] += now - self.start
+        self.stack.append(name)
+        self.start = now
+        try:
+            yield
+        finally:
+            now = time.perf_counter()
+            self.phases[self.stack.pop()] += now - self.start
+            self.start = now
+
+    def as_dict(self, render_cache) -> dict:
+        return {
+            "phases": {name: round(seconds, 6) for name, seconds in self.phases.items()},
+            "calls": dict(sorted(self.calls.items())),
+            "templates": {"written": render_cache.written, "skipped": render_cache.skipped},
+        }
+
+    def report(self, render_cache, output) -> None:
+        stats = self.as_dict(render_cache)
+        if callable(output):
+            return output(stats)
+        if output == "json":
+            return print(json.dumps(stats))
+        lines = [f"{name:<8} {seconds * 1000:10.3f} ms" for name, seconds in stats["phases"].items()]
+        lines += [f"{name:<8} {count:10d} calls" for name, count in stats["calls"].items()]
+        lines += [f"{name:<8} {count:10d} templates" for name, count in stats["templates"].items()]
+        print("\n".join(lines), file=sys.stderr)
+
+
+class Snapshot:
+    """
+    Listing of folders holding dotfiles, read once with os.scandir and queried in memory.
+
+    Links and folders planned in the run are kept in planned, keyed by dotfile.
+    """
+
+    def __init__(self, keep=False):
+        self.folders = {}
+        self.links = {}
+        self.planned = {}
+        self.calls = Counter()
+        # NOTE mtime of folders when listed is only needed to reuse a snapshot for another plan
+        self.mtimes = {} if keep else None
+
+    def listdir(self, folder) -> dict:
+        folder = str(folder)
+        if folder not in self.folders:
+            if self.mtimes is not None:
+                self.calls["stat"] += 1
+                try:
+                    self.mtimes[folder] = (os.stat(folder).st_mtime_ns, time.time_ns())
+                except OSError:
+                    self.mtimes[folder] = None
+            self.calls["scandir"] += 1
+            try:
+                with os.scandir(folder) as entries:
+                    self.folders[folder] = {entry.name: entry for entry in entries}
+            except OSError:
+                self.folders[folder] = {}
+        return self.folders[folder]
+
+    def entry(self, path):
+        return self.listdir(path.parent).get(path.name)
+
+    def exists(self, path, hops=40) -> bool:
+        """
+        Return whether path exists, following links up to hops times like the kernel does.
+        """
+        entry = self.entry(path)
+        if entry is None or not entry.is_symlink():
+            return entry is not None
+        if hops == 0:
+            # NOTE links looping back onto themselves exist nowhere
+            return False
+        target = self.readlink(path)
+        return self.exists(target if target.is_absolute() else path.parent / target, hops - 1)
+
+    def readlink(self, path) -> Path:
+        if str(path) not in self.links:
+            self.calls["readlink"] += 1
+            self.links[str(path)] = Path(os.readlink(path))
+        return self.links[str(path)]
+
+    def refresh(self) -> None:
+        """
+        Forget folders changed since they were listed, and links planned.
+        """
+        # NOTE snapshots not kept have no mtimes, so all their folders are listed again
+        mtimes = self.mtimes if self.mtimes is not None else {}
+        for folder, mtime in list(mtimes.items()):
+            try:
+                current = os.stat(folder).st_mtime_ns
+            except OSError:
+                current = None
+            # NOTE a folder changed in the second before it was listed could change again without its mtime changing
+            if mtime is None or current != mtime[0] or mtime[0] > mtime[1] - 1_000_000_000:
+                del mtimes[folder]
+        self.folders = {folder: entries for folder, entries in self.folders.items() if folder in mtimes}
+        self.links = {path: target for path, target in self.links.items() if str(Path(path).parent) in self.folders}
+        self.planned = {}
+        self.calls = Counter()
+
+
+class Render(NamedTuple):
+    """
+    Render template into rendered file.
+    """
+
+    template: Path
+    rendered: Path
+    key: str
+    digest: str
+    variables: str
+    stat: str
+
+    requires = None
+    # NOTE rendered files do not depend on the home, so they are written once for all homes
+    shared = True
+    stage = 1
+
+    @property
+    def provides(self) -> Path:
+        return self.rendered
+
+    def preconditions(self) -> list:
+        return [["exists", str(self.template)]]
+
+    def undo(self) -> None:
+        # NOTE rendered files only depend on templates and values, rendering them again changes nothing
+        pass
+
+    def apply(self) -> None:
+        # NOTE written next to rendered file then renamed over it, so it is never seen half written
+        tmp = self.rendered.with_name(f".{self.rendered.name}.{os.getpid()}.tmp")
+        # NOTE folder of a store is created along with its first entry
+        self.rendered.parent.mkdir(parents=True, exist_ok=True)
+        existing = self.rendered.exists()
+        if existing:
+            mode = self.rendered.stat().st_mode & 0o7777
+        else:
+            # NOTE values substituted may be secrets, e.g. in a store shared by several users
+            mode = 0o600 if self.variables else 0o666
+        try:
+            # NOTE created with its final mode, so values are never readable by others, even while written
+            tmp.unlink(missing_ok=True)
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, mode)
+            with os.fdopen(fd, "w", encoding="utf-8") as fp:
+                if int(self.stat.split(":")[0]) <= TemplateCache.MAX_TEMPLATE:
+                    segments = TemplateCache(state_path("templates")).segments(self.template, self.stat)
+                    fp.write(TemplateCache.substitute(segments, os.environ))
+                else:
+                    # NOTE placeholders never span lines, so each line is substituted on its own
+                    with open(self.template, "r", encoding="utf-8") as template_file:
+                        fp.writelines(Template(line).safe_substitute(os.environ) for line in template_file)
+            # NOTE mode given to os.open is reduced by umask, unlike the mode of an existing file
+            if existing:
+                os.chmod(tmp, mode)
+            os.replace(tmp, self.rendered)
+        finally:
+            tmp.unlink(missing_ok=True)
+
+    def record(self, render_cache, manifest) -> None:
+        # NOTE size, mtime and digest of rendered file tell whether it was changed since, see verify
+        stat = self.rendered.stat()
+        render_cache.add(
+            self.rendered,
+            template=str(self.template),
+            key=self.key,
+            digest=self.digest,
+            variables=self.variables,
+            stat=self.stat,
+            output=f"{stat.st_size}:{stat.st_mtime_ns}",
+            output_digest=file_digest(self.rendered),
+        )
+
+
+class Symlink(NamedTuple):
+    """
+    Link dotfile to target.
+    """
+
+    dotfile: Path
+    target: Path
+    profile: str
+    mode: str
+
+    provides = None
+    stage = 1
+
+    @property
+    def requires(self) -> Path:
+        return self.target
+
+    @property
+    def shared(self) -> bool:
+        # NOTE links next to rendered templates live in the profile, not in the home
+        return self.mode == "nested"
+
+    def preconditions(self) -> list:
+        return [["absent", str(self.dotfile)]]
+
+    def apply(self) -> None:
+        self.dotfile.symlink_to(self.target)
+
+    def undo(self) -> None:
+        self.dotfile.unlink()
+
+    def record(self, render_cache, manifest) -> None:
+        manifest.add(self.dotfile, self.target, self.profile, self.mode)
+
+
+class Relink(NamedTuple):
+    """
+    Replace link from dotfile to previous target by a link to target.
+    """
+
+    dotfile: Path
+    previous: Path
+    target: Path
+    profile: str
+    mode: str
+
+    provides = None
+    shared = False
+    stage = 1
+
+    @property
+    def requires(self) -> Path:
+        return self.target
+
+    def preconditions(self) -> list:
+        return [["link", str(self.dotfile), str(self.previous)]]
+
+    def replace(self, target) -> None:
+        # NOTE new link is renamed over the previous one, so dotfile never goes missing
+        tmp = self.dotfile.with_name(f".{self.dotfile.name}.{os.getpid()}.tmp")
+        tmp.symlink_to(target)
+        os.replace(tmp, self.dotfile)
+
+    def apply(self) -> None:
+        self.replace(self.target)
+
+    def undo(self) -> None:
+        self.replace(self.previous)
+
+    def record(self, render_cache, manifest) -> None:
+        manifest.add(self.dotfile, self.target, self.profile, self.mode)
+
+
+class Unlink(NamedTuple):
+    """
+    Remove link from dotfile to target.
+    """
+
+    dotfile: Path
+    target: Path
+
+    provides = requires = None
+    shared = False
+    stage = 1
+
+    def preconditions(self) -> list:
+        return [["link", str(self.dotfile), str(self.target)]]
+
+    def apply(self) -> None:
+        self.dotfile.unlink()
+
+    def undo(self) -> None:
+        self.dotfile.symlink_to(self.target)
+
+    def record(self, render_cache, manifest) -> None:
+        manifest.remove(self.dotfile)
+
+
+class Forget(NamedTuple):
+    """
+    Remove dotfile already gone from manifest.
+    """
+
+    dotfile: Path
+
+    provides = requires = None
+    shared = False
+    stage = 1
+
+    def preconditions(self) -> list:
+        return [["absent", str(self.dotfile)]]
+
+    def apply(self) -> None:
+        pass
+
+    def undo(self) -> None:
+        pass
+
+    def record(self, render_cache, manifest) -> None:
+        manifest.remove(self.dotfile)
+
+
+class Mkdir(NamedTuple):
+    """
+    Create folder to hold links of several profiles, in place of link to target when given.
+    """
+
+    dotfile: Path
+    target: str
+
+    provides = requires = None
+    shared = False
+    # NOTE folders are created before links in them, parents first
+    stage = 0
+
+    def preconditions(self) -> list:
+        return [["link", str(self.dotfile), self.target] if self.target else ["absent", str(self.dotfile)]]
+
+    def apply(self) -> None:
+        if self.target:
+            self.dotfile.unlink()
+        self.dotfile.mkdir()
+
+    def undo(self) -> None:
+        self.dotfile.rmdir()
+        if self.target:
+            self.dotfile.symlink_to(self.target)
+
+    def record(self, render_cache, manifest) -> None:
+        manifest.add(self.dotfile, "", "", "directory")
+
+
+class Rmdir(NamedTuple):
+    """
+    Remove folder created by Mkdir, then link it to target of profile when given.
+    """
+
+    dotfile: Path
+    target: str
+    profile: str
+
+    provides = requires = None
+    shared = False
+    # NOTE folders are removed after links in them, children first
+    stage = 2
+
+    def preconditions(self) -> list:
+        return [["exists", str(self.dotfile)]]
+
+    def apply(self) -> None:
+        self.dotfile.rmdir()
+        if self.target:
+            self.dotfile.symlink_to(self.target)
+
+    def undo(self) -> None:
+        if self.target:
+            self.dotfile.unlink()
+        self.dotfile.mkdir()
+
+    def record(self, render_cache, manifest) -> None:
+        manifest.remove(self.dotfile)
+        if self.target:
+            manifest.add(self.dotfile, self.target, self.profile, "folder")
+
+
+class ProfileScan:
+    """
+    Entries of profiles and templates below them, listed once and shared across homes.
+
+    Listings are indexed by directory mtime between runs, so only directories changed since are listed again.
+    """
+
+    def __init__(self, stats, path=None, rescan=False):
+        self.path = path
+        self.index = {} if path is None or rescan else load_json(path, {})
+        self.changed = False
+        self.listings = {}
+        self.templates = {}
+        self.stats = stats
+
+    def listing(self, directory) -> list[list]:
+        """
+        Return name, is_dir, is_file and is_symlink of each entry in directory.
+        """
+        key = str(directory)
+        if key in self.listings:
+            return self.listings[key]
+        self.stats.calls["stat"] += 1
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+        except OSError:
+            self.forget(key)
+            raise
+        cached = self.index.get(key)
+        if cached is not None and cached["mtime"] == mtime:
+            self.listings[key] = cached["entries"]
+            return self.listings[key]
+
+        listed = time.time_ns()
+        self.stats.calls["scandir"] += 1
+        with os.scandir(directory) as entries:
+            listing = sorted([entry.name, entry.is_dir(), entry.is_file(), entry.is_symlink()] for entry in entries)
+        # NOTE a directory changed in the last second could change again without its mtime changing
+        if mtime < listed - 1_000_000_000:
+            self.index[key] = {"mtime": mtime, "entries": listing}
+            self.changed = True
+        else:
+            self.forget(key)
+        self.listings[key] = listing
+        return listing
+
+    def forget(self, key) -> None:
+        if self.index.pop(key, None) is not None:
+            self.changed = True
+
+    def candidates(self, profile) -> list[tuple[Path, bool]]:
+        return [(Path(profile) / name, is_dir) for name, is_dir, *_ in self.listing(profile)]
+
+    def walk(self, candidate, depth) -> list[Path]:
+        if (candidate, depth) not in self.templates:
+            self.templates[candidate, depth] = list(self.walk_templates(candidate, depth))
+        return self.templates[candidate, depth]
+
+    def walk_templates(self, directory, depth):
+        """
+        Yield templates below directory, up to given depth or at any depth when depth is 0.
+        """
+        try:
+            listing = self.listing(directory)
+        except OSError:
+            return
+        for name, is_dir, is_file, is_symlink in listing:
+            if name.endswith(".template") and is_file:
+                yield Path(directory) / name
+            # NOTE links to folders are only followed when depth is bounded
+            elif depth != 1 and is_dir and (depth > 0 or not is_symlink):
+                yield from self.walk_templates(Path(directory) / name, depth - 1 if depth > 0 else 0)
+
+    def refresh(self, stats, rescan=False) -> None:
+        """
+        Start another scan, listing again folders whose mtime changed.
+        """
+        self.listings, self.templates, self.stats = {}, {}, stats
+        if rescan and self.index:
+            self.index, self.changed = {}, True
+
+    def save(self) -> None:
+        if self.path is not None and self.changed:
+            save_json(self.path, self.index)
+            self.changed = False
+
+
+def check(precondition, snapshot) -> Optional[str]:
+    """
+    Return why precondition of a planned operation does not hold, if it does not.
+    """
+    kind, path, *target = precondition
+    path = Path(path)
+    if kind == "exists" and not snapshot.exists(path):
+        return f"File {path} does not exist"
+    if kind == "absent" and snapshot.entry(path) is not None:
+        return f"File {path} exists"
+    if kind == "link":
+        entry = snapshot.entry(path)
+        if entry is None or not entry.is_symlink() or snapshot.readlink(path) != Path(target[0]):
+            return f"File {path} does not point to {target[0]}"
+    return None
+
+
+def dump_operation(operation) -> dict:
+    return {"op": type(operation).__name__, **{key: str(value) for key, value in operation._asdict().items()}}
+
+
+def load_operation(item):
+    cls = operations[item["op"]]
+    return cls(**{key: Path(item[key]) if cls.__annotations__[key] is Path else item[key] for key in cls._fields})
+
+
+def dump_plan(path, command, home, queue) -> None:
+    """
+    Write planned operations and their preconditions to path.
+    """
+    plan = {"command": command, "home": str(home), "operations": []}
+    for operation in queue:
+        plan["operations"].append({**dump_operation(operation), "preconditions": operation.preconditions()})
+    save_json(Path(path), plan)
+
+
+def load_plan(path) -> tuple[Path, list, list]:
+    """
+    Read home, operations and preconditions from a plan written by dump_plan.
+    """
+    plan = load_json(Path(path), None)
+    if plan is None:
+        raise OSError(f"Plan {path} cannot be read")
+    queue, preconditions = [], []
+    for item in plan["operations"]:
+        queue.append(load_operation(item))
+        preconditions.extend(item["preconditions"])
+    return Path(plan["home"]), queue, preconditions
+
+
+def render_link_recurse(*, candidate, recursive, queue, scan, stats, mode=None, tracker=None, **kwargs) -> None:
     """
     Render templates recursively.
     """
-    # TODO only templates in root, n-deep recursing, or any-deep recursing
-    # templates = sorted(candidate.glob("*.template"))
-    templates = sorted(sum([list(candidate.glob("/".join("*" * r) + ".template")) for r in range(recursive)], []))
-    # templates = sorted(candidate.glob("**/*.template"))
-    for subcandidate in templates:
-        if subcandidate.is_file():
-            # NOTE file.template -> file.rendered -> file
-            subname = subcandidate.name
-            subrendered = subcandidate.parent / re.sub(".template$", ".rendered", subname)
-            subdotfile = subcandidate.parent / re.sub(".template$", "", subname)
-            render_single(candidate=subcandidate, rendered=subrendered, queue=queue)
-            link(rendered=subrendered, dotfile=subdotfile, queue=queue)
+    # NOTE recursive is 1 for no templates below candidate, n for (n-1)-deep recursing, 0 for any-deep recursing
+    if recursive == 1 or mode != "folder" or kwargs.get("store") is not None:
+        # NOTE with a store, folders holding templates are unfolded instead, see unfold
+        return
+    subcandidates = scan.walk(candidate, recursive - 1 if recursive > 0 else 0)
+    for index, subcandidate in enumerate(subcandidates):
+        if tracker is not None and tracker.stopped:
+            tracker.unscanned += len(subcandidates) - index
+            return
+        # NOTE file.template -> file.rendered -> file
+        subname = subcandidate.name
+        subdotfile = subcandidate.parent / subname.removesuffix(".template")
+        subrendered = subcandidate.parent / (subdotfile.name + ".rendered")
+        kwargs = {**kwargs, "candidate": subcandidate, "rendered": subrendered, "dotfile": subdotfile, "mode": "nested"}
+        with stats.phase("render"):
+            render_single(queue=queue, scan=scan, stats=stats, **kwargs)
+        with stats.phase("check"):
+            link(queue=queue, scan=scan, stats=stats, **kwargs)
 
 
-def render_single(*, candidate, rendered, queue, **_) -> None:
+def render_single(
+    *, candidate, rendered, queue, render_cache, stats, changed_variables=None, store=None, **_
+) -> Optional[dict]:
     """
-    Render a template.
+    Render a template, returning the store entry linked to instead of the rendered file when there is a store.
     """
+    if candidate != rendered and store is not None:
+        return render_stored(candidate=candidate, queue=queue, render_cache=render_cache, stats=stats, store=store)
 
-    if candidate != rendered:
+    if candidate != rendered and str(rendered) not in render_cache.planned:
+        # NOTE a template reached again, e.g. when linking several homes, is only considered once
+        render_cache.planned.add(str(rendered))
+        stats.calls["stat"] += 1
+        stat = candidate.stat()
+        stat = f"{stat.st_size}:{stat.st_mtime_ns}"
+        entry = render_cache.entries.get(str(rendered))
+        if entry is not None and entry["stat"] == stat:
+            # NOTE template is unchanged, only values of the variables it references matter
+            digest, variables = entry["digest"], entry["variables"]
+            if changed_variables is not None and not changed_variables & set(variables.split(",")):
+                render_cache.skipped += 1
+                return log(
+                    logging.DEBUG,
+                    "File %s does not depend on changed variables.",
+                    rendered,
+                    op="render",
+                    status="skipped",
+                    dotfile=rendered,
+                    target=candidate,
+                )
+        else:
+            stats.calls["read"] += 1
+            digest, variables = RenderCache.read(candidate)
 
-        def func():
-            with open(candidate, "r", encoding="utf-8") as candidate_file:
-                with open(rendered, "w", encoding="utf-8") as rendered_file:
-                    content = Template(candidate_file.read()).safe_substitute(os.environ)
-                    rendered_file.write(content)
+        key = RenderCache.key(digest, variables)
+        if entry is not None and entry["key"] == key and rendered.is_file():
+            if entry["stat"] != stat:
+                render_cache.add(rendered, **{**entry, "stat": stat})
+            render_cache.skipped += 1
+            return log(
+                logging.DEBUG,
+                "File %s is up to date.",
+                rendered,
+                op="render",
+                status="skipped",
+                dotfile=rendered,
+                target=candidate,
+            )
 
-        queue.append(func)
-        logger.info(f"File {rendered} created.")
+        render_cache.written += 1
+        queue.append(Render(candidate, rendered, key, digest, variables, stat))
+        log(
+            logging.INFO,
+            "File %s created.",
+            rendered,
+            op="render",
+            status="created",
+            dotfile=rendered,
+            target=candidate,
+        )
 
 
-def link(*, rendered, dotfile, queue, **_):
+def render_stored(*, candidate, queue, render_cache, stats, store) -> dict:
     """
-    Link dotfiles to files in given profile directories.
+    Render a template into the store, unless an entry for the same template and values is there already.
     """
-    if not dotfile.exists():
+    stats.calls["stat"] += 1
+    stat = candidate.stat()
+    stat = f"{stat.st_size}:{stat.st_mtime_ns}"
+    entry = render_cache.templates.get(str(candidate))
+    if entry is not None and entry["stat"] == stat:
+        digest, variables = entry["digest"], entry["variables"]
+    else:
+        stats.calls["read"] += 1
+        digest, variables = RenderCache.read(candidate)
+
+    key = RenderCache.key(digest, variables)
+    rendered = store.entry(key, variables)
+    if str(rendered) not in render_cache.planned:
+        render_cache.planned.add(str(rendered))
+        stats.calls["stat"] += 1
+        # NOTE entries of others are written again, as anyone writing to the store can compute keys of templates
+        if store.trusted(rendered):
+            # NOTE rendered by another profile or home, whose entry may be missing from the cache
+            render_cache.skipped += 1
+            if entry is None or entry["stat"] != stat:
+                render_cache.add(
+                    rendered, template=str(candidate), key=key, digest=digest, variables=variables, stat=stat
+                )
+            log(
+                logging.DEBUG,
+                "File %s is up to date.",
+                rendered,
+                op="render",
+                status="skipped",
+                dotfile=rendered,
+                target=candidate,
+            )
+        else:
+            render_cache.written += 1
+            queue.append(Render(candidate, rendered, key, digest, variables, stat))
+            log(
+                logging.INFO,
+                "File %s created.",
+                rendered,
+                op="render",
+                status="created",
+                dotfile=rendered,
+                target=candidate,
+            )
+    return {"rendered": rendered, "mode": "stored"}
+
+
+def source_children(source, scan, render_cache, stored=False) -> list[tuple[str, bool]]:
+    """
+    Return name of entries in folder and whether they are folders, including links to templates rendered in the run.
 
-        def func():
-            dotfile.symlink_to(rendered)
+    Templates rendered into a store replace what earlier runs rendered next to them.
+    """
+    children = {name: is_dir for name, is_dir, *_ in scan.listing(source)}
+    for name in list(children):
+        stem = name.removesuffix(".template")
+        if stem == name or children[name]:
+            continue
+        if stored:
+            children.pop(stem, None)
+            children.pop(f"{stem}.rendered", None)
+        elif str(source / f"{stem}.rendered") in render_cache.planned:
+            children.setdefault(stem, False)
+    return sorted(children.items())
+
+
+def templated(rendered, scan, recursive=1, store=None, **_) -> bool:
+    """
+    Return whether a profile folder holds templates rendered into a store, so it cannot be linked as a whole.
+    """
+    return store is not None and recursive != 1 and bool(scan.walk(rendered, recursive - 1 if recursive > 0 else 0))
 
-        queue.append(func)
-        return logger.info(f"File {dotfile} created and linked to {rendered}")
 
-    if not dotfile.is_symlink():
-        return logger.warning(f"File {dotfile} exists but is not a link")
+def unfolded_sources(rendered, dotfile, snapshot, manifest, profile, stored) -> Optional[tuple[list, Optional[str]]]:
+    """
+    Return folders, with their profile, whose entries are linked one by one into dotfile, and link it replaces if any.
+    """
+    entry, planned = snapshot.entry(dotfile), snapshot.planned.get(dotfile)
+    if isinstance(planned, Mkdir) or (entry is not None and not entry.is_symlink() and entry.is_dir()):
+        return [(rendered, profile)], None
+    if isinstance(planned, Symlink) and planned.mode == "folder" and planned.target != rendered:
+        return [(planned.target, planned.profile), (rendered, profile)], ""
+    if entry is None:
+        return ([(rendered, profile)], "") if stored and planned is None else None
+    recorded = manifest.links.get(str(dotfile), {}) if manifest is not None else {}
+    if entry.is_symlink() and recorded.get("mode") == "folder":
+        target = Path(recorded["target"])
+        if (target != rendered or stored) and snapshot.readlink(dotfile) == target:
+            sources = [(target, recorded["profile"])] if target != rendered else []
+            return sources + [(rendered, profile)], str(target)
+    return None
 
-    dotfile_link = dotfile.readlink()
+
+def unfold(*, rendered, dotfile, queue, snapshot, manifest=None, profile=None, mode=None, scan=None, **kwargs) -> bool:
+    """
+    Link entries of a profile folder one by one, when dotfile is a folder or links to a folder of another profile.
+
+    With a store, folders holding templates are also linked entry by entry, as templates link into the store.
+    """
+    # NOTE a folder is linked as a whole, i.e. folded, unless it is shared with the home or other profiles
+    sources = None
+    if mode == "folder" and scan:
+        stored = templated(rendered, scan, **kwargs)
+        sources = unfolded_sources(rendered, dotfile, snapshot, manifest, profile, stored)
+    if sources is None:
+        return False
+
+    sources, previous = sources
+    if previous is not None:
+        if isinstance(snapshot.planned.get(dotfile), Symlink):
+            queue.remove(snapshot.planned[dotfile])
+        snapshot.planned[dotfile] = Mkdir(dotfile, previous)
+        queue.append(snapshot.planned[dotfile])
+        # NOTE folder is created empty, whatever the link it replaces points to
+        snapshot.folders[str(dotfile)] = {}
+        log(
+            logging.INFO,
+            "Folder %s created for links of several profiles",
+            dotfile,
+            op="link",
+            status="unfolded",
+            dotfile=dotfile,
+        )
+    for source, source_profile in sources:
+        link_children(source, source_profile, dotfile, queue, snapshot, manifest, scan, **kwargs)
+    return True
+
+
+def link_children(source, profile, dotfile, queue, snapshot, manifest, scan, recursive=1, **kwargs) -> None:
+    """
+    Link entries of a profile folder into dotfile, rendering templates into the store if any.
+    """
+    stored = kwargs.get("store") is not None and recursive != 1
+    # NOTE templates of subfolders are one level less deep
+    kwargs.update(queue=queue, snapshot=snapshot, manifest=manifest, profile=profile, scan=scan)
+    kwargs["recursive"] = recursive - 1 if recursive > 1 else recursive
+    for name, is_dir in source_children(source, scan, kwargs["render_cache"], stored):
+        child = {"candidate": source / name, "rendered": source / name, "dotfile": dotfile / name}
+        child["mode"] = "folder" if is_dir else "file"
+        if stored and not is_dir and name.endswith(".template"):
+            stem = name.removesuffix(".template")
+            child.update(rendered=source / f"{stem}.rendered", dotfile=dotfile / stem)
+            with kwargs["stats"].phase("render"):
+                child.update(render_single(**{**kwargs, **child}) or {})
+        link(**{**kwargs, **child})
+
+
+def shadow(*, rendered, dotfile, queue, snapshot, mode=None, precedence="error", **_) -> bool:
+    """
+    Resolve link to another file planned for dotfile in the run, returning whether this link is dropped.
+    """
+    planned = snapshot.planned.get(dotfile)
+    if not isinstance(planned, Symlink) or planned.target == rendered:
+        return False
+    if planned.mode == mode == "folder":
+        # NOTE folders provided by several profiles are unfolded instead
+        return False
+    if precedence == "error":
+        log(
+            logging.WARNING,
+            "File %s is provided by both %s and %s",
+            dotfile,
+            planned.target,
+            rendered,
+            op="link",
+            status="conflict",
+            dotfile=dotfile,
+            target=rendered,
+        )
+        return True
+    kept = planned.target if precedence == "first" else rendered
+    log(
+        logging.INFO,
+        "File %s links to %s, shadowing others",
+        dotfile,
+        kept,
+        op="link",
+        status="shadowed",
+        dotfile=dotfile,
+        target=kept,
+    )
+    if precedence == "last":
+        queue.remove(planned)
+        del snapshot.planned[dotfile]
+    return precedence == "first"
+
+
+def link(*, rendered, dotfile, queue, snapshot, manifest=None, profile=None, mode="file", **kwargs):
+    """
+    Link dotfiles to files in given profile directories.
+    """
+    if shadow(rendered=rendered, dotfile=dotfile, queue=queue, snapshot=snapshot, mode=mode, **kwargs):
+        return
+    if unfold(
+        rendered=rendered,
+        dotfile=dotfile,
+        queue=queue,
+        snapshot=snapshot,
+        manifest=manifest,
+        profile=profile,
+        mode=mode,
+        **kwargs,
+    ):
+        return
+
+    entry = snapshot.entry(dotfile)
+    if entry is None:
+        snapshot.planned[dotfile] = Symlink(dotfile, rendered, str(profile), mode)
+        queue.append(snapshot.planned[dotfile])
+        return log(
+            logging.INFO,
+            "File %s created and linked to %s",
+            dotfile,
+            rendered,
+            op="link",
+            status="created",
+            dotfile=dotfile,
+            target=rendered,
+        )
+
+    if not entry.is_symlink():
+        return log(
+            logging.WARNING,
+            "File %s exists but is not a link",
+            dotfile,
+            op="link",
+            status="conflict",
+            dotfile=dotfile,
+            target=rendered,
+        )
+
+    dotfile_link = snapshot.readlink(dotfile)
+    if dotfile_link != rendered and retarget(dotfile, dotfile_link, rendered, queue, manifest, profile, mode):
+        return
     if dotfile_link != rendered:
-        return logger.warning(f"File {dotfile} exists and points to {dotfile_link} instead of {rendered}")
+        return log(
+            logging.WARNING,
+            "File %s exists and points to %s instead of %s",
+            dotfile,
+            dotfile_link,
+            rendered,
+            op="link",
+            status="conflict",
+            dotfile=dotfile,
+            target=rendered,
+        )
 
-    return logger.info(f"File {dotfile} links to {rendered} as expected")
+    if manifest is not None:
+        manifest.add(dotfile, rendered, profile, mode)
+    return log(
+        logging.INFO,
+        "File %s links to %s as expected",
+        dotfile,
+        rendered,
+        op="link",
+        status="unchanged",
+        dotfile=dotfile,
+        target=rendered,
+    )
 
 
-def unlink(*, rendered, dotfile, queue, **_):
+def retarget(dotfile, previous, rendered, queue, manifest, profile, mode) -> bool:
+    """
+    Link dotfile to another entry of the store it links into, once its template or values changed.
+    """
+    recorded = manifest.links.get(str(dotfile), {}) if manifest is not None else {}
+    if not (mode == recorded.get("mode") == "stored" and Path(recorded["target"]) == previous):
+        return False
+    if previous.parent != rendered.parent:
+        return False
+    queue.append(Relink(dotfile, previous, rendered, str(profile), mode))
+    log(
+        logging.INFO,
+        "File %s relinked from %s to %s",
+        dotfile,
+        previous,
+        rendered,
+        op="link",
+        status="relinked",
+        dotfile=dotfile,
+        target=rendered,
+    )
+    return True
+
+
+def unlink(*, rendered, dotfile, queue, snapshot, manifest=None, **_):
     """
     Unlink dotfiles linked to files in given profile directories.
     """
-    if not dotfile.exists():
-        return logger.warning(f"File {dotfile} does not exists")
+    entry = snapshot.entry(dotfile)
+    if entry is None:
+        if manifest is not None and str(dotfile) in manifest.links:
+            queue.append(Forget(dotfile))
+            return log(
+                logging.INFO,
+                "File %s was already removed",
+                dotfile,
+                op="unlink",
+                status="forgotten",
+                dotfile=dotfile,
+                target=rendered,
+            )
+        return log(
+            logging.WARNING,
+            "File %s does not exists",
+            dotfile,
+            op="unlink",
+            status="missing",
+            dotfile=dotfile,
+            target=rendered,
+        )
 
-    if not dotfile.is_symlink():
-        return logger.warning(f"File {dotfile} exists but is not a link")
+    if not entry.is_symlink():
+        return log(
+            logging.WARNING,
+            "File %s exists but is not a link",
+            dotfile,
+            op="unlink",
+            status="conflict",
+            dotfile=dotfile,
+            target=rendered,
+        )
 
-    dotfile_link = dotfile.readlink()
+    dotfile_link = snapshot.readlink(dotfile)
     if dotfile_link != rendered:
-        return logger.warning(f"File {dotfile} exists and points to {dotfile_link} instead of {rendered}")
+        return log(
+            logging.WARNING,
+            "File %s exists and points to %s instead of %s",
+            dotfile,
+            dotfile_link,
+            rendered,
+            op="unlink",
+            status="conflict",
+            dotfile=dotfile,
+            target=rendered,
+        )
 
-    def func():
-        dotfile.unlink()
+    queue.append(Unlink(dotfile, rendered))
+    return log(
+        logging.INFO,
+        "File %s unlinked from %s",
+        dotfile,
+        rendered,
+        op="unlink",
+        status="removed",
+        dotfile=dotfile,
+        target=rendered,
+    )
 
-    queue.append(func)
-    return logger.info(f"File {dotfile} unlinked from {rendered}")
 
+def fold_target(directory, links) -> tuple[Optional[str], str]:
+    """
+    Return profile folder and profile all links below directory point into, "" when there are none, or None.
+    """
+    roots = set()
+    for dotfile, entry in links.items():
+        if entry["mode"] == "directory":
+            continue
+        relative, target = dotfile.relative_to(directory).parts, Path(entry["target"])
+        if target.parts[-len(relative) :] != relative:
+            return None, ""
+        roots.add((str(Path(*target.parts[: -len(relative)])), entry["profile"]))
+    if len(roots) > 1:
+        return None, ""
+    return roots.pop() if roots else ("", "")
 
-def run(command, home, profiles, recursive, queue):
-    home = Path(home).expanduser().resolve()
-    if not home.is_dir():
-        return logger.warning(f"Folder {home} does not exist")
-    for profile in profiles:
-        profile = Path(profile).expanduser().resolve()
-        if not profile.is_dir():
-            logger.warning(f"Profile {profile} does not exist")
+
+def tracked(directory, manifest, snapshot) -> bool:
+    """
+    Return whether folder only holds links and folders recorded in manifest.
+    """
+    for name in snapshot.listdir(directory):
+        recorded = manifest.links.get(str(directory / name))
+        if recorded is None or (recorded["mode"] == "directory" and not tracked(directory / name, manifest, snapshot)):
+            return False
+    return True
+
+
+def fold(*, queue, snapshot, manifest, **_) -> None:
+    """
+    Remove folders created by unfold once emptied, or link them again if links left are from one profile folder.
+    """
+    removed = {str(operation.dotfile) for operation in queue if isinstance(operation, (Unlink, Forget))}
+    links = {Path(dotfile): entry for dotfile, entry in manifest.links.items() if dotfile not in removed}
+    folded = []
+    for directory in sorted(dotfile for dotfile, entry in links.items() if entry["mode"] == "directory"):
+        if any(directory.is_relative_to(parent) for parent in folded):
             continue
-        for candidate in sorted(profile.glob("*")):
-            name = candidate.name
-            if name.startswith(".") or (name.endswith(".rendered") and candidate.is_file()):
-                logger.debug(f"File {candidate} ignored.")
-                continue
-            # Add dot prefix and replace template when needed
-            if candidate.is_dir():
-                rendered = candidate
-                dotfile = home / ("." + name)
+        below = {dotfile: entry for dotfile, entry in links.items() if directory in dotfile.parents}
+        target, profile = fold_target(directory, below)
+        # NOTE folders holding files of other programs are left as they are
+        if target is None or not tracked(directory, manifest, snapshot):
+            continue
+        for dotfile, entry in sorted(below.items(), reverse=True):
+            if entry["mode"] == "directory":
+                queue.append(Rmdir(dotfile, "", ""))
             else:
-                # NOTE file.template -> file.rendered -> .file
-                rendered = candidate.parent / re.sub(".template$", ".rendered", name)
-                dotfile = home / ("." + re.sub(".template$", "", name))
-            # Run user requested command
-            for func in commands[command]:
+                unlink(
+                    rendered=Path(entry["target"]), dotfile=dotfile, queue=queue, snapshot=snapshot, manifest=manifest
+                )
+        queue.append(Rmdir(directory, target, profile))
+        folded.append(directory)
+        log(
+            logging.INFO,
+            "Folder %s folded into %s",
+            directory,
+            target or "nothing",
+            op="unlink",
+            status="folded",
+            dotfile=directory,
+            target=target or None,
+        )
+
+
+def status(*, rendered, dotfile, queue, snapshot, manifest=None, prune=False, **_):
+    """
+    Show status of dotfiles linked to files in given profile directories.
+    """
+    entry = snapshot.entry(dotfile)
+    if entry is None:
+        state = "missing"
+    elif not entry.is_symlink() or snapshot.readlink(dotfile) != rendered:
+        state = "conflict"
+    elif not snapshot.exists(rendered):
+        state = "dangling"
+    else:
+        state = "linked"
+    print(f"{state} {dotfile} -> {rendered}")
+
+    if prune and manifest is not None and str(dotfile) in manifest.links:
+        if state == "dangling":
+            unlink(rendered=rendered, dotfile=dotfile, queue=queue, snapshot=snapshot, manifest=manifest)
+        elif state == "missing":
+            queue.append(Forget(dotfile))
+            log(
+                logging.INFO,
+                "File %s removed from manifest",
+                dotfile,
+                op="status",
+                status="forgotten",
+                dotfile=dotfile,
+                target=rendered,
+            )
+
+
+def source_name(profile, path) -> Optional[str]:
+    """
+    Return name of the entry in profile that path is or is below, without template suffix.
+    """
+    try:
+        name = path.relative_to(profile).parts[0]
+    except (ValueError, IndexError):
+        return None
+    return name.removesuffix(".template").removesuffix(".rendered")
+
+
+def run_manifest(command, profile, queue, manifest, stats, only=None, **kwargs) -> None:
+    """
+    Run command on links recorded in manifest, without scanning the profile.
+    """
+    tracker = kwargs.get("tracker")
+    for dotfile, entry in manifest.entries(profile):
+        if tracker is not None and tracker.stopped:
+            tracker.unscanned += 1
+            continue
+        if command == "unlink" and entry["mode"] == "nested":
+            # NOTE links next to rendered templates live in the profile, not in the home
+            log(
+                logging.DEBUG,
+                "File %s kept in profile.",
+                dotfile,
+                op="unlink",
+                status="kept",
+                dotfile=dotfile,
+                target=entry["target"],
+            )
+            continue
+        if only is not None and source_name(profile, Path(entry["target"])) not in only:
+            continue
+        for func in commands[command]:
+            with stats.phase(phases.get(func.__name__, "check")):
                 func(
-                    candidate=candidate,
-                    rendered=rendered,
+                    candidate=None,
+                    rendered=Path(entry["target"]),
                     dotfile=dotfile,
-                    recursive=recursive,
+                    profile=profile,
+                    mode=entry["mode"],
                     queue=queue,
+                    manifest=manifest,
+                    stats=stats,
+                    **kwargs,
                 )
 
 
+def ignored(candidate, is_dir) -> bool:
+    return candidate.name.startswith(".") or (candidate.name.endswith(".rendered") and not is_dir)
+
+
+def dotfile_of(home, candidate, is_dir) -> tuple[Path, Path, str]:
+    """
+    Return file linked to, dotfile and mode of an entry of a profile.
+    """
+    # Add dot prefix and replace template when needed
+    if is_dir:
+        return candidate, home / ("." + candidate.name), "folder"
+    # NOTE file.template -> file.rendered -> .file
+    stem = candidate.name.removesuffix(".template")
+    if stem == candidate.name:
+        return candidate, home / ("." + stem), "file"
+    return candidate.parent / (stem + ".rendered"), home / ("." + stem), "template"
+
+
+def shadowed_sources(home, profiles, scan, precedence) -> Optional[set[Path]]:
+    """
+    Return entries of profiles hidden by another profile providing the same dotfile, or None on conflicts.
+
+    Dotfiles are indexed from profile listings alone, before the home is looked at.
+    """
+    index = {}
+    for profile in profiles:
+        for candidate, is_dir in scan.candidates(profile):
+            if not ignored(candidate, is_dir):
+                # NOTE a profile given twice provides the same entries
+                index.setdefault(dotfile_of(home, candidate, is_dir)[1], {})[candidate] = is_dir
+
+    shadowed, conflicted = set(), False
+    for dotfile, sources in index.items():
+        # NOTE folders provided by several profiles are unfolded instead
+        if len(sources) == 1 or all(sources.values()):
+            continue
+        candidates = list(sources)
+        if precedence == "error":
+            conflicted = True
+            log(
+                logging.WARNING,
+                "File %s is provided by several profiles: %s",
+                dotfile,
+                ", ".join(map(str, candidates)),
+                op="link",
+                status="conflict",
+                dotfile=dotfile,
+            )
+            continue
+        kept = candidates[0] if precedence == "first" else candidates[-1]
+        shadowed.update(candidate for candidate in candidates if candidate != kept)
+        log(
+            logging.INFO,
+            "File %s links to %s, shadowing others",
+            dotfile,
+            kept,
+            op="link",
+            status="shadowed",
+            dotfile=dotfile,
+            target=kept,
+        )
+    return None if conflicted else shadowed
+
+
+def run_profile(command, home, profile, queue, scan, stats, only=None, shadowed=(), **kwargs) -> None:
+    """
+    Run command on files in profile.
+    """
+    with stats.phase("scan"):
+        candidates = scan.candidates(profile)
+    tracker = kwargs.get("tracker")
+    for index, (candidate, is_dir) in enumerate(candidates):
+        if tracker is not None and tracker.stopped:
+            tracker.unscanned += len(candidates) - index
+            return
+        if ignored(candidate, is_dir):
+            log(logging.DEBUG, "File %s ignored.", candidate, op="scan", status="ignored", dotfile=candidate)
+            continue
+        if candidate in shadowed or (only is not None and source_name(profile, candidate) not in only):
+            continue
+        rendered, dotfile, mode = dotfile_of(home, candidate, is_dir)
+        arguments = {"candidate": candidate, "rendered": rendered, "dotfile": dotfile, "profile": profile, "mode": mode}
+        # Run user requested command
+        for func in commands[command]:
+            with stats.phase(phases.get(func.__name__, "check")):
+                # NOTE a function may return arguments of the next ones, e.g. the store entry a template is rendered to
+                arguments.update(func(queue=queue, scan=scan, stats=stats, **arguments, **kwargs) or {})
+
+
+def run(command, home, profiles, recursive, queue, manifest=None, **kwargs):
+    home = Path(home).expanduser().resolve()
+    if not home.is_dir():
+        return logger.warning("Folder %s does not exist", home)
+    if not profiles and manifest is not None:
+        profiles = manifest.profiles()
+    recorded = manifest.profiles() if manifest is not None else []
+    folders = []
+    for profile in profiles:
+        profile = Path(profile).expanduser().resolve()
+        if command in manifest_commands and str(profile) in recorded:
+            run_manifest(command, profile, recursive=recursive, queue=queue, manifest=manifest, **kwargs)
+        elif not profile.is_dir():
+            logger.warning("Profile %s does not exist", profile)
+        else:
+            folders.append(profile)
+    shadowed = set()
+    if command == "link":
+        with kwargs["stats"].phase("scan"):
+            shadowed = shadowed_sources(home, folders, kwargs["scan"], kwargs.get("precedence", "error"))
+        if shadowed is None:
+            return
+    for profile in folders:
+        run_profile(
+            command, home, profile, recursive=recursive, queue=queue, manifest=manifest, shadowed=shadowed, **kwargs
+        )
+    if command == "unlink" and manifest is not None:
+        fold(queue=queue, manifest=manifest, **kwargs)
+
+
+def execute(queue, jobs=1, done=None) -> list[Optional[BaseException]]:
+    """
+    Execute operations in queue, concurrently on jobs threads when jobs > 1, calling done after each one, if given.
+
+    Operations requiring a rendered file run once it is written. Return the error of each operation, if any.
+    """
+
+    def apply(operation, dependency):
+        # NOTE exception() waits for the dependency to finish
+        if dependency is not None and dependency.exception() is not None:
+            raise RuntimeError(f"Skipped since {operation.requires} was not rendered")
+        operation.apply()
+        if done is not None:
+            done(operation)
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    futures, provided = [], {}
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        for operation in queue:
+            # NOTE dependencies are submitted first, so a worker never waits on a task still queued
+            futures.append(pool.submit(apply, operation, provided.get(operation.requires)))
+            if operation.provides is not None:
+                provided[operation.provides] = futures[-1]
+    return [future.exception() for future in futures]
+
+
+def execute_stages(queue, jobs, done=None) -> dict:
+    """
+    Execute operations stage by stage and return the exception raised by each, if any.
+    """
+    results = {}
+    for stage in sorted({operation.stage for operation in queue}):
+        ready = [operation for operation in queue if operation.stage == stage]
+        # NOTE folders are created and removed one at a time, in the order planned
+        results.update(zip(ready, execute(ready, jobs=jobs if stage == 1 else 1, done=done)))
+    return results
+
+
+def start_journals(queues, journals=None) -> tuple[list, Callable]:
+    """
+    Start a journal for each home, unless given, and return them along with a callback journaling done operations.
+    """
+    if journals is None:
+        journals = [Journal(manifest) for manifest, _ in queues]
+        for journal, (manifest, queue) in zip(journals, queues):
+            journal.start(queue, manifest)
+    owners = {}
+    for journal, (_, queue) in zip(journals, queues):
+        for operation in queue:
+            owners.setdefault(operation, []).append(journal)
+
+    def done(operation):
+        for journal in owners[operation]:
+            journal.done(operation)
+
+    return journals, done
+
+
+def apply_queues(queues, jobs, render_cache, stats=None, journals=None) -> list[str]:
+    """
+    Execute queue of each home and record operations done in render cache, manifests and journals.
+
+    Operations shared by homes run first and once. Homes then run concurrently on jobs threads.
+    Journals of homes are removed once all their operations succeeded.
+    """
+    journals, done = start_journals(queues, journals)
+    shared = list(dict.fromkeys(operation for _, queue in queues for operation in queue if operation.shared))
+    results = dict(zip(shared, execute(shared, jobs=jobs, done=done)))
+    failed = {op.provides for op in shared if op.provides is not None and results[op] is not None}
+    if any(isinstance(operation, Render) for operation in shared):
+        TemplateCache(state_path("templates")).evict()
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    def apply_home(queue):
+        ready = [op for op in queue if not op.shared and (op.requires is None or op.requires not in failed)]
+        return execute_stages(ready, jobs=jobs if len(queues) == 1 else 1, done=done)
+
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        homes = list(pool.map(apply_home, [queue for _, queue in queues]))
+
+    errors = [f"{type(op).__name__} {op[0]} failed: {results[op]}" for op in shared if results[op] is not None]
+    if stats is not None:
+        stats.calls.update(type(op).__name__.lower() for op in shared if results[op] is None)
+    for (manifest, queue), home, journal in zip(queues, homes, journals):
+        home_errors = record_home(manifest, queue, {**results, **home}, render_cache, stats)
+        journal.close(keep=bool(home_errors))
+        errors.extend(error for error in home_errors if error is not None)
+    render_cache.save()
+    return errors
+
+
+def record_home(manifest, queue, results, render_cache, stats=None) -> list[Optional[str]]:
+    """
+    Record operations done in a home and return errors of the others, None for shared operations that failed.
+    """
+    errors = []
+    for operation in queue:
+        error = results.get(operation, f"Skipped since {operation.requires} was not rendered")
+        if error is None:
+            operation.record(render_cache, manifest)
+            if stats is not None and not operation.shared:
+                stats.calls[type(operation).__name__.lower()] += 1
+        else:
+            # NOTE errors of shared operations are reported once, with all homes
+            errors.append(None if operation.shared else f"{type(operation).__name__} {operation[0]} failed: {error}")
+    manifest.save()
+    return errors
+
+
 class AddWarningTrackerHandlerContext:
-    def __init__(self):
+    def __init__(self, fail_fast=False):
         class WarningTrackerHandler(logging.Handler):
             def __init__(self):
                 super().__init__()
                 self.warning_called = False
+                self.conflicts = []
+                self.fail_fast = fail_fast
+                self.unscanned = 0
+
+            @property
+            def stopped(self) -> bool:
+                # NOTE with fail fast, scanning stops at the first conflict
+                return self.fail_fast and self.warning_called
 
             def emit(self, record):
                 if record.levelno == logging.WARNING:
                     self.warning_called = True
+                    self.conflicts.append(record.getMessage())
 
         self.handler = WarningTrackerHandler()
 
@@ -197,71 +1806,782 @@ class AddWarningTrackerHandlerContext:
         logger.removeHandler(self.handler)
 
 
-def dot(command, home, profiles, recursive, dry_run, verbose) -> None:
+def set_verbosity(verbose, log_format="text") -> None:
     if verbose == 0:
         level = logging.WARNING
     elif verbose == 1:
         level = logging.INFO
     else:
         level = logging.DEBUG
-    logger.setLevel(level)
+    get_logger().setLevel(level)
+    for handler in logger.handlers:
+        if handler.get_name() == "dot.py":
+            handler.setFormatter(JSONFormatter() if log_format == "json" else formatter)
+
 
-    # Build queue
-    queue = []
+def read_homes(home) -> list[str]:
+    """
+    Return homes given as a folder or list of folders, where @file stands for the folders listed in file.
+    """
+    homes = []
+    for value in [home] if isinstance(home, (str, Path)) else home or ["~"]:
+        if str(value).startswith("@"):
+            with open(Path(str(value)[1:]).expanduser(), "r", encoding="utf-8") as fp:
+                homes.extend(line.strip() for line in fp if line.strip() and not line.startswith("#"))
+        else:
+            homes.append(str(value))
+    return homes
 
-    with AddWarningTrackerHandlerContext() as handler:
-        run(command, home, profiles, recursive=recursive, queue=queue)
 
-        if handler.warning_called:
+def plan_homes(command, homes, profiles, fail_fast=False, snapshots=None, **kwargs) -> tuple[list, dict, list]:
+    """
+    Plan command for each home, sharing profile scan and renders.
+
+    Return queues, homes with conflicts along with entries left unscanned in them, and conflicts.
+    """
+    queues, conflicted, conflicts, shared = [], {}, [], []
+    for home in homes:
+        queue = []
+        manifest = Manifest(Path(home).expanduser().resolve())
+        if snapshots is None:
+            snapshot = Snapshot()
+        else:
+            snapshot = snapshots.setdefault(str(manifest.home), Snapshot(keep=True))
+            snapshot.refresh()
+        with AddWarningTrackerHandlerContext(fail_fast) as handler:
+            run(command, home, profiles, queue=queue, manifest=manifest, snapshot=snapshot, tracker=handler, **kwargs)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Filesystem calls: %s.", dict(sorted(snapshot.calls.items())))
+            kwargs["stats"].calls.update(snapshot.calls)
+
+            conflicts.extend(handler.conflicts)
+            if handler.warning_called:
+                conflicted[home] = handler.unscanned
+                # NOTE renders are planned once, with the first home reaching them
+                shared.extend(operation for operation in queue if operation.shared)
+                continue
+
+        # NOTE the same file can be reached more than once, e.g. through overlapping profiles
+        queues.append((manifest, list(dict.fromkeys(queue))))
+    if queues and shared:
+        queues[0] = (queues[0][0], list(dict.fromkeys(shared + queues[0][1])))
+    return queues, conflicted, conflicts
+
+
+class Result(NamedTuple):
+    """
+    Operations planned for each home, conflicts found, time spent and errors raised when applied.
+    """
+
+    queues: list
+    conflicts: list[str]
+    conflicted: dict[str, int]
+    timings: Stats
+    errors: list[str]
+
+    @property
+    def operations(self) -> list:
+        return [operation for _, queue in self.queues for operation in queue]
+
+
+class Planner:
+    """
+    Plan and apply commands for profiles in homes, keeping listings and templates from one plan to the next.
+
+    Folders of profiles and homes are listed again only once their mtime changes. Conflicts are returned, not raised.
+    """
+
+    def __init__(self, keep=True):
+        self.render_cache = RenderCache(state_path("render.json"))
+        self.scan = ProfileScan(Stats(), state_path("scan.json"))
+        # NOTE listings of homes are only worth their extra stat calls when planning more than once
+        self.snapshots = {} if keep else None
+
+    def plan(
+        self,
+        command,
+        home,
+        profiles,
+        recursive=1,
+        prune=False,
+        only=None,
+        changed_vars=None,
+        rescan=False,
+        precedence="error",
+        fail_fast=False,
+        store=None,
+    ) -> Result:
+        timings = Stats()
+        self.scan.refresh(timings, rescan)
+        self.render_cache.planned, self.render_cache.skipped, self.render_cache.written = set(), 0, 0
+        with timings.phase("plan"):
+            queues, conflicted, conflicts = plan_homes(
+                command,
+                read_homes(home),
+                profiles,
+                recursive=recursive,
+                render_cache=self.render_cache,
+                scan=self.scan,
+                snapshots=self.snapshots,
+                stats=timings,
+                prune=prune,
+                only=only,
+                changed_variables=set(changed_vars.split(",")) if changed_vars else None,
+                precedence=precedence,
+                fail_fast=fail_fast,
+                store=Store(store) if store is not None else None,
+            )
+        return Result(queues, conflicts, conflicted, timings, [])
+
+    def apply(self, result, jobs=1) -> Result:
+        # NOTE listings are only written once applied, so that dry runs leave no state behind
+        if not result.conflicted:
+            self.scan.save()
+        errors = []
+        if any(queue for _, queue in result.queues):
+            with result.timings.phase("execute"):
+                errors = apply_queues(result.queues, jobs=jobs, render_cache=self.render_cache, stats=result.timings)
+        return result._replace(errors=errors)
+
+
+def recover(home, rollback=False, dry_run=False, jobs=1) -> list[str]:
+    """
+    Apply operations an interrupted or failed run left undone in each home, or undo the ones it did.
+    """
+    render_cache, errors = RenderCache(state_path("render.json")), []
+    for folder in read_homes(home):
+        manifest = Manifest(Path(folder).expanduser().resolve())
+        journal = Journal(manifest)
+        loaded = journal.load()
+        if loaded is None:
+            logger.info("No interrupted run in %s.", manifest.home)
+            continue
+        queue, done, links = loaded
+        completed = set(done)
+        left = list(reversed(done)) if rollback else [operation for operation in queue if operation not in completed]
+        for operation in left:
+            logger.info("%s %s %s.", "Undo" if rollback else "Apply", type(operation).__name__, operation[0])
+        if dry_run:
+            continue
+        if rollback:
+            errors.extend(undo(left, manifest, journal, links))
+            continue
+        for operation in done:
+            # NOTE a killed run did not record operations it did
+            operation.record(render_cache, manifest)
+        journal.start(queue, manifest, links, done)
+        errors.extend(apply_queues([(manifest, left)], jobs=jobs, render_cache=render_cache, journals=[journal]))
+    return errors
+
+
+def undo(done, manifest, journal, links) -> list[str]:
+    """
+    Undo operations, last done first, restoring links recorded before them, and return errors.
+    """
+    for index, operation in enumerate(done):
+        try:
+            operation.undo()
+        except OSError as error:
+            manifest.save()
+            # NOTE operations left are journaled again, to retry once fixed
+            journal.start(list(reversed(done[index:])), manifest, links, reversed(done[index:]))
+            journal.close(keep=True)
+            return [f"Undo {type(operation).__name__} {operation[0]} failed: {error}"]
+        manifest.restore(operation[0], links.get(str(operation[0])))
+    manifest.save()
+    journal.close()
+    return []
+
+
+def report_errors(errors) -> None:
+    for error in errors:
+        logger.error("Error: %s", error)
+    if errors:
+        raise SystemExit(1)
+
+
+def report_conflicts(result, fail_fast) -> None:
+    """
+    Log homes skipped for conflicts, and exit when there is a single home.
+    """
+    for home, unscanned in result.conflicted.items():
+        if fail_fast:
+            logger.error("Error: Stopped at first conflict, %d entries left unscanned.", unscanned)
+        if not result.queues and len(result.conflicted) == 1:
             logger.error("Error: There were conflicts. Exiting without changing dotfiles.")
             raise SystemExit(1)
+        logger.error("Error: There were conflicts in %s. Skipping it.", home)
+
+
+def dot(
+    command,
+    home,
+    profiles,
+    recursive,
+    dry_run,
+    verbose,
+    prune=False,
+    jobs=1,
+    output=None,
+    only=None,
+    changed_vars=None,
+    stats=None,
+    log_format="text",
+    rescan=False,
+    precedence="error",
+    fail_fast=False,
+    store=None,
+    resume=False,
+    rollback=False,
+) -> None:
+    """
+    Run command for profiles in home, where stats, if given, is "text", "json" or a callable taking a dict.
+
+    Precedence is "first" or "last" for the profile whose file is linked when several provide a dotfile, or "error".
+    Templates are rendered into store, if given, instead of next to them. Resume or rollback an interrupted run
+    instead of planning again.
+    """
+    set_verbosity(verbose, log_format)
+
+    if resume or rollback:
+        return report_errors(recover(home, rollback=rollback, dry_run=dry_run, jobs=jobs))
+
+    # Build queues
+    planner = Planner(keep=False)
+    options = {"recursive": recursive, "prune": prune, "only": only, "changed_vars": changed_vars, "rescan": rescan}
+    options.update(precedence=precedence, fail_fast=fail_fast, store=store)
+    result = planner.plan(command, home, profiles, **options)
+    report_conflicts(result, fail_fast)
+
+    if output is not None:
+        if len(result.queues) != 1 or result.conflicted:
+            logger.error("Error: A plan is written for a single home.")
+            raise SystemExit(1)
+        manifest, queue = result.queues[0]
+        dump_plan(output, command, manifest.home, queue)
+        return logger.info("Plan with %d operations written to %s", len(queue), output)
 
-    # Execute queue
+    # Execute queues
     if not dry_run:
-        for func in queue:
-            func()
+        result = planner.apply(result, jobs=jobs)
 
+    render_cache = planner.render_cache
+    if render_cache.written or render_cache.skipped:
+        logger.info("Templates rendered: %d written, %d skipped.", render_cache.written, render_cache.skipped)
+    if stats is not None:
+        result.timings.report(render_cache, stats)
+
+    report_errors(result.errors)
+    if result.conflicted:
+        raise SystemExit(1)
+
+
+def apply_plan(plan, dry_run, verbose, jobs=1, stats=None, log_format="text") -> None:
+    """
+    Apply a plan written by the plan command, checking its preconditions instead of scanning profiles.
+    """
+    set_verbosity(verbose, log_format)
+
+    try:
+        home, queue, preconditions = load_plan(plan)
+    except (OSError, KeyError, TypeError) as error:
+        logger.error("Error: %s", error)
+        raise SystemExit(1)
+
+    timings = Stats()
+    snapshot = Snapshot()
+    with timings.phase("check"), AddWarningTrackerHandlerContext() as handler:
+        for precondition in preconditions:
+            message = check(precondition, snapshot)
+            if message is not None:
+                logger.warning(message)
+
+        if handler.warning_called:
+            logger.error("Error: Plan is out of date. Exiting without changing dotfiles.")
+            raise SystemExit(1)
+
+    timings.calls.update(snapshot.calls)
+    render_cache = RenderCache(state_path("render.json"))
+    errors = []
+    if not dry_run and queue:
+        with timings.phase("execute"):
+            errors = apply_queues([(Manifest(home), queue)], jobs=jobs, render_cache=render_cache, stats=timings)
+    if stats is not None:
+        timings.report(render_cache, stats)
+
+    report_errors(errors)
+
+
+class PollingWatcher:
+    """
+    Detect changes below folders by comparing modification times of their entries.
+    """
+
+    def __init__(self, folders):
+        self.folders = folders
+        self.state = self.scan()
+
+    def scan(self) -> dict[Path, tuple[int, int]]:
+        state, stack = {}, list(self.folders)
+        while stack:
+            try:
+                with os.scandir(stack.pop()) as entries:
+                    for entry in entries:
+                        stat = entry.stat(follow_symlinks=False)
+                        state[Path(entry.path)] = (stat.st_mtime_ns, stat.st_size)
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+            except OSError:
+                continue
+        return state
+
+    def changes(self, timeout) -> set[Path]:
+        time.sleep(timeout)
+        state, self.state = self.state, self.scan()
+        return {path for path in state.keys() | self.state.keys() if state.get(path) != self.state.get(path)}
+
+    def close(self) -> None:
+        pass
+
+
+class InotifyWatcher:
+    """
+    Detect changes below folders with inotify, through ctypes.
+    """
+
+    # NOTE IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    MASK: int = 0x2 | 0x4 | 0x8 | 0x40 | 0x80 | 0x100 | 0x200
+    IN_ISDIR: int = 0x40000000
+    IN_Q_OVERFLOW: int = 0x4000
+
+    def __init__(self, folders):
+        import ctypes
+        import ctypes.util
+
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.folders = folders
+        self.watches = {}
+        for folder in folders:
+            self.add(folder)
+
+    def add(self, folder) -> None:
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(folder), self.MASK)
+        if wd < 0:
+            return
+        self.watches[wd] = Path(folder)
+        try:
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        self.add(entry.path)
+        except OSError:
+            pass
+
+    def read(self) -> set[Path]:
+        import struct
+
+        changed = set()
+        while True:
+            try:
+                buffer = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return changed
+            offset = 0
+            while offset < len(buffer):
+                wd, mask, _, length = struct.unpack_from("iIII", buffer, offset)
+                name = buffer[offset + 16 : offset + 16 + length].rstrip(b"\0")
+                offset += 16 + length
+                if mask & self.IN_Q_OVERFLOW:
+                    changed.update(self.folders)
+                elif wd in self.watches:
+                    path = self.watches[wd] / os.fsdecode(name)
+                    changed.add(path)
+                    if mask & self.IN_ISDIR and mask & (0x80 | 0x100):
+                        self.add(path)
+
+    def changes(self, timeout) -> set[Path]:
+        import select
+
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return set()
+        # NOTE wait briefly so that a burst of events, e.g. from an editor saving, is handled at once
+        time.sleep(0.05)
+        return self.read()
+
+    def close(self) -> None:
+        os.close(self.fd)
 
-def dot_from_args(*, prog: str = "dot.py") -> None:
-    def parse_args(prog):
-        class ColoredArgumentParser(ArgumentParser):
-            def print_usage(self, file=None):
-                if file is None:
-                    file = sys.stdout
-                self._print_message(formatter.format_(self.format_usage(), logging.WARNING), file)
-
-            def print_help(self, file=None):
-                if file is None:
-                    file = sys.stdout
-                self._print_message(formatter.format_(self.format_help(), logging.DEBUG), file)
-
-            def error(self, message):
-                self.print_usage(sys.stderr)
-                self.exit(2, formatter.format_(f"Error: {self.prog}: {message.strip()}", logging.ERROR) + "\n")
-
-        parser = ColoredArgumentParser(prog=prog, description=__doc__)
-        subparsers = parser.add_subparsers(dest="command", required=True)
-        for key, funcs in commands.items():
-            subparser = subparsers.add_parser(key, description=funcs[-1].__doc__)
-            subparser.add_argument("profiles", nargs="+")
-            subparser.add_argument("--home", nargs="?", default="~")
-            subparser.add_argument(
-                "-r",
-                "--recursive",
-                action="count",
-                default=1,
-                help="increase depth of recursion when rendering templates",
-            )
-            subparser.add_argument("-v", "--verbose", action="count", default=0)
-            subparser.add_argument("-d", "--dry-run", default=False, action=BooleanOptionalAction)
-        return vars(parser.parse_args())
 
-    dot(**parse_args(prog))
+def make_watcher(folders):
+    """
+    Return inotify watcher, falling back to polling where inotify is not available.
+    """
+    if sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(folders)
+        except (OSError, AttributeError) as error:
+            logger.debug("Inotify not available, polling instead: %s", error)
+    return PollingWatcher(folders)
+
+
+def relink(home, profiles, changed, **kwargs) -> None:
+    """
+    Link entries of profiles below changed paths, and unlink the ones removed.
+    """
+    for profile in profiles:
+        profile = Path(profile).expanduser().resolve()
+        if profile in changed:
+            linked, unlinked = None, set()
+        else:
+            # NOTE rendered files are written by dot.py itself
+            paths = [path for path in changed if not path.name.endswith(".rendered")]
+            names = {name for name in (source_name(profile, path) for path in paths) if name}
+            names = {name for name in names if not name.startswith(".")}
+            present = {source_name(profile, candidate) for candidate in profile.glob("*")} if names else set()
+            linked, unlinked = names & present, names - present
+        for command, only in [("link", linked), ("unlink", unlinked)]:
+            if only is not None and not only:
+                continue
+            try:
+                dot(command, home, [str(profile)], only=only, **kwargs)
+            except SystemExit:
+                logger.error("Error: Profile %s not updated, waiting for next change.", profile)
+
+
+def watch(
+    home,
+    profiles,
+    recursive,
+    dry_run,
+    verbose,
+    jobs=1,
+    stats=None,
+    interval=1.0,
+    iterations=None,
+    log_format="text",
+    rescan=False,
+    precedence="error",
+    fail_fast=False,
+    store=None,
+) -> None:
+    """
+    Link dotfiles, then relink them as files in given profile directories change.
+    """
+    kwargs = {"recursive": recursive, "dry_run": dry_run, "verbose": verbose, "jobs": jobs, "stats": stats}
+    kwargs.update(log_format=log_format, precedence=precedence, fail_fast=fail_fast, store=store)
+    dot("link", home, profiles, rescan=rescan, **kwargs)
+
+    folders = [Path(profile).expanduser().resolve() for profile in profiles]
+    watcher = make_watcher(folders)
+    try:
+        while iterations is None or iterations > 0:
+            changed = watcher.changes(interval)
+            if changed:
+                relink(home, profiles, changed, **kwargs)
+            if iterations is not None:
+                iterations -= 1
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+
+def deps(profiles, verbose, log_format="text") -> None:
+    """
+    Show templates depending on each variable, as recorded when last rendered.
+    """
+    set_verbosity(verbose, log_format)
+    profiles = [Path(profile).expanduser().resolve() for profile in profiles]
+    for variable, templates in RenderCache(state_path("render.json")).dependencies().items():
+        templates = [t for t in templates if not profiles or any(Path(t).is_relative_to(p) for p in profiles)]
+        if templates:
+            print(f"{variable}: {' '.join(templates)}")
+
+
+def gc(store, dry_run, verbose, log_format="text") -> None:
+    """
+    Remove entries of a store no home links to anymore.
+    """
+    set_verbosity(verbose, log_format)
+    entries = Store(store).unreferenced()
+    for path, _ in entries:
+        if not dry_run:
+            path.unlink(missing_ok=True)
+        log(logging.INFO, "File %s removed.", path, op="gc", status="removed", dotfile=path)
+    logger.info("Store entries removed: %d, %d bytes.", len(entries), sum(size for _, size in entries))
+
+
+def rendered_drift(rendered, entry, render_cache) -> Optional[str]:
+    """
+    Return how rendered file differs from what its template and values render to, if it does.
+
+    Sizes and mtimes are compared first, files are only read when they differ.
+    """
+    stat = rendered.stat()
+    current = {**entry, "output": f"{stat.st_size}:{stat.st_mtime_ns}"}
+    if current["output"] != entry.get("output"):
+        current["output_digest"] = file_digest(rendered)
+        # NOTE files rendered before digests were recorded are trusted as they are
+        if entry.get("output_digest") not in (None, current["output_digest"]):
+            return "modified"
+    try:
+        stat = os.stat(entry["template"])
+    except OSError:
+        return "outdated"
+    current["stat"] = f"{stat.st_size}:{stat.st_mtime_ns}"
+    if current["stat"] != entry["stat"]:
+        current["digest"], current["variables"] = RenderCache.read(entry["template"])
+    if RenderCache.key(current["digest"], current["variables"]) != entry["key"]:
+        return "outdated"
+    if current != entry:
+        render_cache.add(rendered, **current)
+    return None
+
+
+def verify_link(dotfile, entry, snapshot, render_cache) -> str:
+    """
+    Return state of a link recorded in manifest: linked, missing, dangling, modified, outdated or conflict.
+    """
+    found = snapshot.entry(dotfile)
+    if found is None:
+        return "missing"
+    if entry["mode"] == "directory":
+        return "linked" if found.is_dir(follow_symlinks=False) else "conflict"
+    target = Path(entry["target"])
+    if not found.is_symlink() or snapshot.readlink(dotfile) != target:
+        return "conflict"
+    if not snapshot.exists(target):
+        return "dangling"
+    rendered = render_cache.entries.get(entry["target"])
+    return (rendered_drift(target, rendered, render_cache) if rendered is not None else None) or "linked"
+
+
+def verify(home, profiles, verbose, log_format="text") -> None:
+    """
+    Check dotfiles still link to files in given profile directories and rendered files are up to date.
+
+    Exit with 3 when some drifted from their profiles, 4 when some conflict with other files, 0 otherwise.
+    """
+    set_verbosity(verbose, log_format)
+    render_cache, states = RenderCache(state_path("render.json")), Counter()
+    selected = {str(Path(profile).expanduser().resolve()) for profile in profiles}
+    for folder in read_homes(home):
+        manifest, snapshot = Manifest(Path(folder).expanduser().resolve()), Snapshot()
+        # NOTE only links recorded in manifests are checked, profiles are not scanned
+        for dotfile, entry in sorted(manifest.links.items()):
+            if selected and entry["profile"] not in selected:
+                continue
+            state = verify_link(Path(dotfile), entry, snapshot, render_cache)
+            states[state] += 1
+            if state != "linked":
+                print(f"{state} {dotfile} -> {entry['target']}")
+    render_cache.save()
+    if states["conflict"]:
+        raise SystemExit(4)
+    if set(states) - {"linked"}:
+        raise SystemExit(3)
+
+
+def add_profile_arguments(subparser, key) -> None:
+    from argparse import BooleanOptionalAction
+
+    if key == "plan":
+        subparser.add_argument("action", choices=["link", "unlink"])
+        subparser.add_argument("-o", "--output", required=True, help="file to write plan to")
+    # NOTE status defaults to all profiles recorded in the manifest
+    subparser.add_argument("profiles", nargs="*" if key == "status" else "+")
+    add_home_argument(subparser)
+    subparser.add_argument(
+        "-r",
+        "--recursive",
+        action="count",
+        default=1,
+        help="increase depth of recursion when rendering templates",
+    )
+    subparser.add_argument(
+        "-R",
+        "--recursive-all",
+        action="store_const",
+        const=0,
+        dest="recursive",
+        help="render templates at any depth",
+    )
+    subparser.add_argument(
+        "--fail-fast",
+        default=False,
+        action="store_true",
+        help="stop scanning profiles at the first conflict",
+    )
+    subparser.add_argument(
+        "--rescan",
+        default=False,
+        action="store_true",
+        help="list every profile folder again instead of reusing listings of unchanged folders",
+    )
+    if key in ("link", "plan", "watch"):
+        subparser.add_argument(
+            "--precedence",
+            choices=["first", "last", "error"],
+            default="error",
+            help="profile linked when several provide the same dotfile, or fail before changing anything",
+        )
+        subparser.add_argument(
+            "--store",
+            help="render templates into a folder shared by profiles, homes and users, named after their content",
+        )
+        subparser.add_argument(
+            "--default-store",
+            action="store_const",
+            const=str(state_path("store", kind="state")),
+            dest="store",
+            help="render templates into the store under $XDG_STATE_HOME/dot.py",
+        )
+    if key in ("link", "unlink"):
+        group = subparser.add_mutually_exclusive_group()
+        group.add_argument(
+            "--resume",
+            default=False,
+            action="store_true",
+            help="apply operations an interrupted run left undone instead of planning again",
+        )
+        group.add_argument(
+            "--rollback",
+            default=False,
+            action="store_true",
+            help="undo operations done by an interrupted or failed run",
+        )
+    if key == "link":
+        subparser.add_argument(
+            "--changed-vars",
+            help="comma separated variables whose values changed, to only render templates depending on them",
+        )
+    if key == "watch":
+        subparser.add_argument("--interval", type=float, default=1.0, help="seconds between checks for changes")
+    if key == "status":
+        subparser.add_argument(
+            "--prune",
+            default=False,
+            action=BooleanOptionalAction,
+            help="unlink dangling links and forget removed links",
+        )
+
+
+def add_home_argument(subparser) -> None:
+    subparser.add_argument(
+        "--home",
+        action="append",
+        help="home folder, defaults to ~, repeat for several homes or give @file listing them",
+    )
+
+
+def add_log_arguments(subparser) -> None:
+    subparser.add_argument("-v", "--verbose", action="count", default=0)
+    subparser.add_argument(
+        "--log-format",
+        choices=["text", "json"],
+        default="text",
+        help="write log records as colored text or as one JSON object per line",
+    )
+
+
+def add_execution_arguments(subparser) -> None:
+    from argparse import BooleanOptionalAction
+
+    add_log_arguments(subparser)
+    subparser.add_argument(
+        "--stats",
+        action="store_const",
+        const="text",
+        help="report time spent in each phase and filesystem operations",
+    )
+    subparser.add_argument(
+        "--stats-format",
+        choices=["text", "json"],
+        dest="stats",
+        help="report stats as text or as a JSON object",
+    )
+    subparser.add_argument("-d", "--dry-run", default=False, action=BooleanOptionalAction)
+    subparser.add_argument("-j", "--jobs", type=int, default=1, help="number of operations run concurrently")
+
+
+def parse_args(prog):
+    # NOTE argparse is only imported when called from the command line
+    from argparse import ArgumentParser
+
+    class ColoredArgumentParser(ArgumentParser):
+        def print_usage(self, file=None):
+            if file is None:
+                file = sys.stdout
+            self._print_message(formatter.format_(self.format_usage(), logging.WARNING), file)
+
+        def print_help(self, file=None):
+            if file is None:
+                file = sys.stdout
+            self._print_message(formatter.format_(self.format_help(), logging.DEBUG), file)
+
+        def error(self, message):
+            self.print_usage(sys.stderr)
+            self.exit(2, formatter.format_(f"Error: {self.prog}: {message.strip()}", logging.ERROR) + "\n")
+
+    parser = ColoredArgumentParser(prog=prog, description=__doc__)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for key, description in descriptions.items():
+        subparser = subparsers.add_parser(key, description=description)
+        add_profile_arguments(subparser, key)
+        add_execution_arguments(subparser)
+    subparser = subparsers.add_parser("deps", description=deps.__doc__)
+    subparser.add_argument("profiles", nargs="*")
+    add_log_arguments(subparser)
+    subparser = subparsers.add_parser("verify", description=verify.__doc__)
+    subparser.add_argument("profiles", nargs="*")
+    add_home_argument(subparser)
+    add_log_arguments(subparser)
+    subparser = subparsers.add_parser("gc", description=gc.__doc__)
+    subparser.add_argument("--store", default=str(state_path("store", kind="state")), help="folder of the store")
+    subparser.add_argument("-d", "--dry-run", default=False, action="store_true")
+    add_log_arguments(subparser)
+    subparser = subparsers.add_parser("apply", description=apply_plan.__doc__)
+    subparser.add_argument("plan")
+    add_execution_arguments(subparser)
+    return vars(parser.parse_args())
+
+
+def dot_from_args(*, prog: str = "dot.py") -> None:
+    args = parse_args(prog)
+    command = args.pop("command")
+    if command == "apply":
+        return apply_plan(**args)
+    if command == "watch":
+        return watch(**args)
+    if command == "deps":
+        return deps(**args)
+    if command == "gc":
+        return gc(**args)
+    if command == "verify":
+        return verify(**args)
+    if command == "plan":
+        command = args.pop("action")
+    dot(command=command, **args)
 
 
 formatter: ColoredFormatter = ColoredFormatter()
-logger: logging.Logger = get_logger()
-commands: dict[str, list[Callable]] = {"link": [render_link_recurse, render_single, link], "unlink": [unlink]}
+logger: logging.Logger = logging.getLogger("dot.py")
+commands: dict[str, list[Callable]] = {
+    "link": [render_link_recurse, render_single, link],
+    "unlink": [unlink],
+    "status": [status],
+}
+manifest_commands: set[str] = {"unlink", "status"}
+phases: dict[str, str] = {"render_link_recurse": "scan", "render_single": "render"}
+descriptions: dict[str, Optional[str]] = {
+    **{key: funcs[-1].__doc__ for key, funcs in commands.items()},
+    "plan": "Write operations for link or unlink and their preconditions to a file, without changing dotfiles.",
+    "watch": watch.__doc__,
+}
+operations: dict[str, type] = {cls.__name__: cls for cls in (Render, Symlink, Relink, Unlink, Forget, Mkdir, Rmdir)}
 
 
 if __name__ == "__main__":
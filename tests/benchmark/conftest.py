@@ -0,0 +1,67 @@
+import json
+import os
+import platform
+import random
+import time
+from pathlib import Path
+
+import pytest
+
+
+def make_profile(root, files=200, folders=20, depth=5, files_per_folder=10, template_fraction=0.2, template_size=1024):
+    """
+    Create a synthetic profile with files at top level and folders nested up to depth.
+    """
+    rng = random.Random(0)
+    line = "export BENCHMARK_VALUE=$BENCHMARK_VALUE\n"
+    template = (line * (template_size // len(line) + 1))[:template_size]
+
+    def write(path):
+        if rng.random() < template_fraction:
+            path, content = path.with_name(path.name + ".template"), template
+        else:
+            content = "x" * template_size
+        with open(path, "w") as fp:
+            fp.write(content)
+
+    profile = root / "profile"
+    profile.mkdir(parents=True)
+    for i in range(files):
+        write(profile / f"file{i}")
+    for i in range(folders):
+        folder = profile / f"folder{i}"
+        for level in range(depth):
+            folder.mkdir()
+            for j in range(files_per_folder):
+                write(folder / f"file{j}")
+            folder = folder / f"level{level}"
+    return profile
+
+
+@pytest.fixture(autouse=True)
+def xdg(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    monkeypatch.setenv("XDG_STATE_HOME", str(tmp_path / "state"))
+    monkeypatch.setenv("BENCHMARK_VALUE", "1")
+    yield tmp_path
+
+
+@pytest.fixture(scope="session")
+def results():
+    """
+    Collect timings and write them as JSON, to $DOT_BENCHMARK_OUTPUT or benchmark.json, when done.
+    """
+    results = []
+    yield results
+    output = Path(os.environ.get("DOT_BENCHMARK_OUTPUT", "benchmark.json"))
+    with open(output, "w") as fp:
+        json.dump(
+            {
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "results": results,
+            },
+            fp,
+            indent=1,
+        )
@@ -0,0 +1,55 @@
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import pytest
+from conftest import make_profile
+
+from dot import dot
+
+pytestmark = pytest.mark.benchmark
+
+
+def timed(results, name, recursive, **kwargs):
+    start = time.perf_counter()
+    dot(recursive=recursive, verbose=0, **kwargs)
+    results.append({"name": name, "recursive": recursive, "seconds": time.perf_counter() - start})
+
+
+@pytest.mark.parametrize("recursive", [1, 2, 3, 4, 5])
+@pytest.mark.parametrize("name", ["link", "relink", "unlink", "dry-run"])
+def test_benchmark(tmp_path, results, name, recursive):
+    home = tmp_path / "home"
+    home.mkdir()
+    profile = make_profile(tmp_path)
+    kwargs = {"home": str(home), "profiles": [str(profile)]}
+
+    if name in ["relink", "unlink"]:
+        dot(command="link", recursive=recursive, dry_run=False, verbose=0, **kwargs)
+
+    command = "unlink" if name == "unlink" else "link"
+    timed(results, name, recursive, command=command, dry_run=name == "dry-run", **kwargs)
+
+
+# NOTE generous budget in microseconds, so that only imports added back to the no-op path fail it
+STARTUP_BUDGET = 150_000
+
+
+def test_startup_importtime(tmp_path, results):
+    home = tmp_path / "home"
+    profile = tmp_path / "default"
+    home.mkdir()
+    profile.mkdir()
+
+    script = Path(__file__).parents[2] / "dot.py"
+    call = [sys.executable, "-X", "importtime", "-S", str(script), "link", str(profile), "--home", str(home)]
+    result = subprocess.run(call, capture_output=True, text=True)
+    assert result.returncode == 0
+
+    # NOTE each line is "import time: self | cumulative | name", where top-level imports are not indented
+    imports = [line.split("|") for line in result.stderr.splitlines() if line.startswith("import time:")]
+    imports = [(int(cumulative), name[1:]) for _, cumulative, name in imports[1:]]
+    startup = sum(cumulative for cumulative, name in imports if not name.startswith(" "))
+    results.append({"name": "startup", "recursive": 1, "seconds": startup / 1e6})
+    assert startup < STARTUP_BUDGET
@@ -40,3 +40,13 @@ def root(tmp_path):
     home = root / "home"
     home.mkdir(parents=True)
     yield root
+
+
+@pytest.fixture(autouse=True)
+def xdg(tmp_path, monkeypatch):
+    """
+    Keep caches and state written by dot.py out of the real home.
+    """
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    monkeypatch.setenv("XDG_STATE_HOME", str(tmp_path / "state"))
+    yield tmp_path
@@ -1,4 +1,6 @@
 import subprocess
+import sys
+from pathlib import Path
 
 import pytest
 from conftest import skipna
@@ -33,7 +35,9 @@ def test_error_code_cli(cli, root, command, home_folder, dry_run):
 
 
 @pytest.mark.parametrize("cli", [skipna("dot.py"), skipna("./dot.py"), "python -m dot"])
-@pytest.mark.parametrize("command", [None, "link", "unlink"])
+@pytest.mark.parametrize(
+    "command", [None, "link", "unlink", "status", "plan", "apply", "watch", "deps", "gc", "verify"]
+)
 def test_error_code_help_cli(cli, root, command):
     command = [command] if command else []
 
@@ -43,10 +47,57 @@ def test_error_code_help_cli(cli, root, command):
 
 
 @pytest.mark.parametrize("cli", [skipna("dot.py"), skipna("./dot.py"), "python -m dot"])
-@pytest.mark.parametrize("command", [None, "link", "unlink"])
+@pytest.mark.parametrize("command", [None, "link", "unlink", "plan", "apply", "watch"])
 def test_error_code_missing_cli(cli, root, command):
     command = [command] if command else []
 
     call = cli.split(" ") + command
     error_code = subprocess.call(call)
     assert error_code == 2
+
+
+@pytest.mark.parametrize("args", [["-c", "import dot"], ["link", "{profile}", "--home", "{home}"]])
+def test_startup_imports(root, args):
+    home = root / "home"
+    profile = root / "default"
+    profile.mkdir()
+
+    script = Path(__file__).parents[2] / "dot.py"
+    args = [arg.format(profile=profile, home=home) for arg in args]
+    call = [sys.executable, "-X", "importtime", "-S", *(args if args[0] == "-c" else [str(script), *args])]
+    result = subprocess.run(call, capture_output=True, text=True, cwd=script.parent)
+    assert result.returncode == 0
+
+    modules = {line.split("|")[-1].strip() for line in result.stderr.splitlines() if line.startswith("import time:")}
+    # NOTE executor is only imported to apply operations, and argparse only to parse the command line
+    assert "concurrent.futures" not in modules
+    assert ("argparse" in modules) == (args[0] != "-c")
+
+
+def test_stats_before_profile(root):
+    home = root / "home"
+    profile = root / "default"
+    profile.mkdir()
+
+    script = Path(__file__).parents[2] / "dot.py"
+    for args, expected in [(["--stats"], "scandir"), (["--stats-format", "json"], '"phases"')]:
+        call = [sys.executable, str(script), "link", *args, str(profile), "--home", str(home)]
+        result = subprocess.run(call, capture_output=True, text=True)
+        assert result.returncode == 0
+        assert expected in result.stdout + result.stderr
+
+
+def test_store_before_profiles(root):
+    home = root / "home"
+    profiles = [root / "default", root / "work"]
+    for profile in profiles:
+        profile.mkdir()
+        with open(profile / f"{profile.name}.template", "w") as fp:
+            fp.write("$HOME")
+
+    script = Path(__file__).parents[2] / "dot.py"
+    call = [sys.executable, str(script), "link", "--store", str(root / "store"), *map(str, profiles)]
+    assert subprocess.call([*call, "--home", str(home)]) == 0
+    assert sorted(path.name for path in home.iterdir()) == [".default", ".work"]
+    # NOTE both templates render the same content into one entry
+    assert len(list((root / "store" / "objects").iterdir())) == 1
@@ -3,6 +3,7 @@ import pytest
 doc_mapping = {
     "link": "Link dotfiles to files in given profile directories.",
     "unlink": "Unlink dotfiles linked to files in given profile directories.",
+    "status": "Show status of dotfiles linked to files in given profile directories.",
 }
 
 
